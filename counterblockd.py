@@ -16,6 +16,7 @@ import datetime
 import ConfigParser
 import time
 import email.utils
+import atexit
 
 import appdirs
 import pymongo
@@ -28,7 +29,7 @@ redis.connection.socket = gevent.socket #make redis play well with gevent
 from socketio import server as socketio_server
 import pygeoip
 
-from lib import (config, api, events, blockfeed, siofeeds, util)
+from lib import (config, api, events, blockfeed, siofeeds, util, txlog, util_log)
 
 
 if __name__ == '__main__':
@@ -42,7 +43,11 @@ if __name__ == '__main__':
     parser.add_argument('--data-dir', help='specify to explicitly override the directory in which to keep the config file and log file')
     parser.add_argument('--config-file', help='the location of the configuration file')
     parser.add_argument('--log-file', help='the location of the log file')
+    parser.add_argument('--log-ingest-level', help='while catching up, drop per-message block feed log entries below this level (e.g. DEBUG, INFO, WARNING). Defaults to WARNING')
     parser.add_argument('--tx-log-file', help='the location of the transaction log file')
+    parser.add_argument('--tx-log-max-response-length', type=int, help='truncate API responses in the transaction log to this many characters (0 to log responses in full). Defaults to 4096')
+    parser.add_argument('--tx-log-sample-rates', help='the fraction (0 to 1) of calls to log to the transaction log, per API method, as a comma separated list of method:rate pairs (a method of * sets the rate for all other methods). Defaults to logging all calls')
+    parser.add_argument('--tx-log-compress', action='store_true', default=False, help='write the transaction log as a series of gzip-compressed segment files')
     parser.add_argument('--pid-file', help='the location of the pid file')
 
     #THINGS WE CONNECT TO
@@ -51,8 +56,9 @@ if __name__ == '__main__':
     parser.add_argument('--counterpartyd-rpc-user', help='the username used to communicate with counterpartyd over JSON-RPC')
     parser.add_argument('--counterpartyd-rpc-password', help='the password used to communicate with counterpartyd over JSON-RPC')
 
-    parser.add_argument('--blockchain-service-name', help='the blockchain service name to connect to')
-    parser.add_argument('--blockchain-service-connect', help='the blockchain service server URL base to connect to, if not default')
+    parser.add_argument('--blockchain-service-name', help='the blockchain service name to connect to (or a comma separated list of them, to use several at once)')
+    parser.add_argument('--blockchain-service-connect', help='the blockchain service server URL base to connect to, if not default (comma separated, if several services are used)')
+    parser.add_argument('--http-client-concurrency', type=int, help='the max number of concurrent (pooled, keep-alive) connections kept per host for outgoing HTTP requests, such as to blockchain services. Defaults to 10')
 
     parser.add_argument('--mongodb-connect', help='the hostname of the mongodb server to connect to')
     parser.add_argument('--mongodb-port', type=int, help='the port used to communicate with mongodb')
@@ -75,6 +81,7 @@ if __name__ == '__main__':
     parser.add_argument('--socketio-port', type=int, help='port on which to provide the counterblockd socket.io API')
     parser.add_argument('--socketio-chat-host', help='the interface on which to host the counterblockd socket.io chat API')
     parser.add_argument('--socketio-chat-port', type=int, help='port on which to provide the counterblockd socket.io chat API')
+    parser.add_argument('--push-markets-list', action='store_true', default=False, help='push the dex markets list to socket.io clients on every new block')
 
     parser.add_argument('--rollbar-token', help='the API token to use with rollbar (leave blank to disable rollbar integration)')
     parser.add_argument('--rollbar-env', help='the environment name for the rollbar integration (if enabled). Defaults to \'production\'')
@@ -171,6 +178,25 @@ if __name__ == '__main__':
     else:
         config.BLOCKCHAIN_SERVICE_CONNECT = None #use default specified by the library
 
+    #multiple services may be specified, comma separated (e.g. insight,sochain), each with their own (optional) endpoint
+    # in blockchain-service-connect (comma separated as well, in the same order)
+    config.BLOCKCHAIN_SERVICE_NAMES = [name.strip() for name in config.BLOCKCHAIN_SERVICE_NAME.split(',')]
+    for name in config.BLOCKCHAIN_SERVICE_NAMES:
+        if name not in ('blockr', 'insight', 'sochain'):
+            raise Exception("Unknown blockchain service: %s" % name)
+    connects = [connect.strip() for connect in (config.BLOCKCHAIN_SERVICE_CONNECT or '').split(',')]
+    config.BLOCKCHAIN_SERVICE_CONNECTS = dict([(name, connects[i] if i < len(connects) and connects[i] else None)
+        for i, name in enumerate(config.BLOCKCHAIN_SERVICE_NAMES)])
+
+    if args.http_client_concurrency:
+        config.HTTP_CLIENT_CONCURRENCY = args.http_client_concurrency
+    elif has_config and configfile.has_option('Default', 'http-client-concurrency') and configfile.get('Default', 'http-client-concurrency'):
+        config.HTTP_CLIENT_CONCURRENCY = configfile.getint('Default', 'http-client-concurrency')
+    else:
+        config.HTTP_CLIENT_CONCURRENCY = 10
+    if config.HTTP_CLIENT_CONCURRENCY <= 0:
+        raise Exception("http-client-concurrency must be a positive integer")
+
     # mongodb host
     if args.mongodb_connect:
         config.MONGODB_CONNECT = args.mongodb_connect
@@ -356,6 +382,14 @@ if __name__ == '__main__':
     except:
         raise Exception("Please specific a valid port number socketio-chat-port configuration parameter")
 
+    # markets list push
+    if args.push_markets_list:
+        config.PUSH_MARKETS_LIST = args.push_markets_list
+    elif has_config and configfile.has_option('Default', 'push-markets-list'):
+        config.PUSH_MARKETS_LIST = configfile.getboolean('Default', 'push-markets-list')
+    else:
+        config.PUSH_MARKETS_LIST = False
+
 
     ##############
     # OTHER SETTINGS
@@ -374,12 +408,43 @@ if __name__ == '__main__':
     else:
         config.LOG = os.path.join(config.DATA_DIR, 'counterblockd.log')
         
+    if args.log_ingest_level:
+        config.LOG_INGEST_LEVEL = args.log_ingest_level
+    elif has_config and configfile.has_option('Default', 'log-ingest-level'):
+        config.LOG_INGEST_LEVEL = configfile.get('Default', 'log-ingest-level')
+    else:
+        config.LOG_INGEST_LEVEL = 'WARNING'
+    if not isinstance(logging.getLevelName(config.LOG_INGEST_LEVEL.upper()), int):
+        raise Exception("Invalid log ingest level: %s" % config.LOG_INGEST_LEVEL)
+    config.LOG_INGEST_LEVEL = logging.getLevelName(config.LOG_INGEST_LEVEL.upper())
+
     if args.tx_log_file:
         config.TX_LOG = args.tx_log_file
     elif has_config and configfile.has_option('Default', 'tx-log-file'):
         config.TX_LOG = configfile.get('Default', 'tx-log-file')
     else:
         config.TX_LOG = os.path.join(config.DATA_DIR, 'counterblockd-tx.log')
+
+    if args.tx_log_max_response_length is not None:
+        config.TX_LOG_MAX_RESPONSE_LENGTH = args.tx_log_max_response_length
+    elif has_config and configfile.has_option('Default', 'tx-log-max-response-length'):
+        config.TX_LOG_MAX_RESPONSE_LENGTH = configfile.getint('Default', 'tx-log-max-response-length')
+    else:
+        config.TX_LOG_MAX_RESPONSE_LENGTH = 4096
+
+    if args.tx_log_sample_rates:
+        config.TX_LOG_SAMPLE_RATES = txlog.parse_sample_rates(args.tx_log_sample_rates)
+    elif has_config and configfile.has_option('Default', 'tx-log-sample-rates'):
+        config.TX_LOG_SAMPLE_RATES = txlog.parse_sample_rates(configfile.get('Default', 'tx-log-sample-rates'))
+    else:
+        config.TX_LOG_SAMPLE_RATES = {}
+
+    if args.tx_log_compress:
+        config.TX_LOG_COMPRESS = args.tx_log_compress
+    elif has_config and configfile.has_option('Default', 'tx-log-compress'):
+        config.TX_LOG_COMPRESS = configfile.getboolean('Default', 'tx-log-compress')
+    else:
+        config.TX_LOG_COMPRESS = False
     
 
     # PID
@@ -462,22 +527,16 @@ if __name__ == '__main__':
     formatter = logging.Formatter('%(asctime)s %(message)s', '%Y-%m-%d-T%H:%M:%S%z')
     fileh.setFormatter(formatter)
     logger.addHandler(fileh)
+    #hand console and file logging off to a background writer, so that logging doesn't block the gevent loop
+    util_log.init([console, fileh])
+    atexit.register(util_log.flush)
     #socketio logging (don't show on console in normal operation)
     socketio_log = logging.getLogger('socketio')
     socketio_log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
     socketio_log.propagate = False
-    #Transaction log
-    tx_logger = logging.getLogger("transaction_log") #get transaction logger
-    tx_logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
-    if os.name == 'nt':
-        tx_fileh = util_windows.SanitizedRotatingFileHandler(config.TX_LOG, maxBytes=MAX_LOG_SIZE, backupCount=MAX_LOG_COUNT)
-    else:
-        tx_fileh = logging.handlers.RotatingFileHandler(config.TX_LOG, maxBytes=MAX_LOG_SIZE, backupCount=MAX_LOG_COUNT)
-    tx_fileh.setLevel(logging.DEBUG if args.verbose else logging.INFO)
-    tx_formatter = logging.Formatter('%(asctime)s %(message)s', '%Y-%m-%d-T%H:%M:%S%z')
-    tx_fileh.setFormatter(tx_formatter)
-    tx_logger.addHandler(tx_fileh)
-    tx_logger.propagate = False
+    #Transaction log (written out in the background)
+    txlog.init(MAX_LOG_SIZE, MAX_LOG_COUNT)
+    atexit.register(txlog.flush)
     
     #xnova(7/16/2014): Disable for now, as this uses requests under the surface, which may not be safe for a gevent-based app
     #rollbar integration
@@ -531,6 +590,18 @@ if __name__ == '__main__':
         ("asset", pymongo.ASCENDING),
         ("block_time", pymongo.ASCENDING)
     ])
+    #current_balances
+    mongo_db.current_balances.ensure_index([
+        ("address", pymongo.ASCENDING),
+        ("asset", pymongo.ASCENDING)
+    ], unique=True)
+    mongo_db.current_balances.ensure_index('block_index') #for pruning
+    #address_activity
+    mongo_db.address_activity.ensure_index([
+        ("address", pymongo.ASCENDING),
+        ("message_index", pymongo.DESCENDING)
+    ])
+    mongo_db.address_activity.ensure_index('block_index') #for pruning
     #asset_market_info
     mongo_db.asset_market_info.ensure_index('asset', unique=True)
     #asset_marketcap_history
@@ -598,6 +669,8 @@ if __name__ == '__main__':
 
     #mempool
     mongo_db.mempool.ensure_index('tx_hash')
+    #address_pubkeys
+    mongo_db.address_pubkeys.ensure_index('address', unique=True)
 
     #Connect to redis
     if config.REDIS_ENABLE_APICACHE:
@@ -631,12 +704,16 @@ if __name__ == '__main__':
     #start up event timers that don't depend on the feed being fully caught up
     logging.debug("Starting event timer: check_blockchain_service")
     gevent.spawn(events.check_blockchain_service)
+    logging.debug("Starting event timer: track_blockchain_tip")
+    gevent.spawn(events.track_blockchain_tip)
     logging.debug("Starting event timer: expire_stale_prefs")
     gevent.spawn(events.expire_stale_prefs)
     logging.debug("Starting event timer: expire_stale_btc_open_order_records")
     gevent.spawn(events.expire_stale_btc_open_order_records)
     logging.debug("Starting event timer: generate_wallet_stats")
     gevent.spawn(events.generate_wallet_stats)
+    logging.debug("Starting event timer: compile_markets_list")
+    gevent.spawn(events.compile_markets_list, zmq_publisher_eventfeed)
 
     logging.info("Starting up RPC API handler...")
     api.serve_api(mongo_db, redis_client)
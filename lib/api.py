@@ -11,6 +11,9 @@ import copy
 import uuid
 import urllib
 import functools
+import heapq
+import itertools
+import inspect
 
 from logging import handlers as logging_handlers
 from gevent import wsgi
@@ -23,8 +26,8 @@ import pymongo
 from bson import json_util
 from bson.son import SON
 
-from lib import config, siofeeds, util, blockchain, util_bitcoin
-from lib.components import betting, rps, assets_trading, dex
+from lib import config, siofeeds, util, blockchain, util_bitcoin, txlog
+from lib.components import betting, rps, assets_trading, dex, prices, portfolio, address_activity
 
 PREFERENCES_MAX_LENGTH = 100000 #in bytes, as expressed in JSON
 API_MAX_LOG_SIZE = 10 * 1024 * 1024 #max log size of 20 MB before rotation (make configurable later)
@@ -33,6 +36,46 @@ API_MAX_LOG_COUNT = 10
 decimal.setcontext(decimal.Context(prec=8, rounding=decimal.ROUND_HALF_EVEN))
 D = decimal.Decimal
 
+def _build_rpc_method_table(dispatcher):
+    """Returns a dict of method name -> (function, accepted param names (None if any are), required param names) for
+    the API methods registered with the dispatcher, so that requests can be checked against each method's signature
+    without inspecting it each time"""
+    method_table = {}
+    for name, func in dispatcher.items():
+        argspec = inspect.getargspec(func)
+        num_required = len(argspec.args) - len(argspec.defaults or ())
+        method_table[name] = (func, None if argspec.keywords else frozenset(argspec.args), frozenset(argspec.args[:num_required]))
+    return method_table
+
+def _dispatch_rpc_request(method_table, request_data):
+    """Calls the API method of the (already parsed and validated) JSON-RPC 2.0 request, returning the response as a
+    dict. Errors are reported as jsonrpc.JSONRPCResponseManager reports them"""
+    response = {'jsonrpc': '2.0', 'id': request_data['id']}
+    if request_data['method'] not in method_table:
+        response['error'] = jsonrpc.exceptions.JSONRPCMethodNotFound()._data
+        return response
+    func, accepted_params, required_params = method_table[request_data['method']]
+    params = request_data.get('params', None) or {}
+
+    unexpected_params = set(params.keys()) - accepted_params if accepted_params is not None else set()
+    missing_params = required_params - set(params.keys())
+    if unexpected_params or missing_params:
+        response['error'] = jsonrpc.exceptions.JSONRPCInvalidParams(data={
+            'type': 'TypeError',
+            'args': [],
+            'message': "%s: unexpected params: %s; missing params: %s" % (request_data['method'],
+                ', '.join(sorted(unexpected_params)) or 'none', ', '.join(sorted(missing_params)) or 'none'),
+        })._data
+        return response
+
+    try:
+        response['result'] = func(**params)
+    except Exception, e:
+        data = {'type': e.__class__.__name__, 'args': e.args, 'message': str(e)}
+        logging.exception("API Exception: %s" % data)
+        response['error'] = jsonrpc.exceptions.JSONRPCServerError(data=data)._data
+    return response
+
 
 def serve_api(mongo_db, redis_client):
     # Preferneces are just JSON objects... since we don't force a specific form to the wallet on
@@ -42,7 +85,6 @@ def serve_api(mongo_db, redis_client):
 
     DEFAULT_COUNTERPARTYD_API_CACHE_PERIOD = 60 #in seconds
     app = flask.Flask(__name__)
-    tx_logger = logging.getLogger("transaction_log") #get transaction logger
 
     @dispatcher.add_method
     def is_ready():
@@ -50,13 +92,12 @@ def serve_api(mongo_db, redis_client):
         If the server is NOT caught up, a 525 error will be returned actually before hitting this point. Thus,
         if we actually return data from this function, it should always be true. (may change this behaviour later)"""
 
-        blockchainInfo = blockchain.getinfo()
         ip = flask.request.headers.get('X-Real-Ip', flask.request.remote_addr)
         country = config.GEOIP.country_code_by_addr(ip)
         return {
             'caught_up': util.is_caught_up_well_enough_for_government_work(),
             'last_message_index': config.LAST_MESSAGE_INDEX,
-            'block_height': blockchainInfo['info']['blocks'],
+            'block_height': blockchain.get_block_height(),
             'testnet': config.TESTNET,
             'ip': ip,
             'country': country
@@ -76,15 +117,11 @@ def serve_api(mongo_db, redis_client):
     @dispatcher.add_method
     def get_messagefeed_messages_by_index(message_indexes):
         messages = util.call_jsonrpc_api("get_messages_by_index", {'message_indexes': message_indexes}, abort_on_error=True)['result']
-        events = []
-        for m in messages:
-            events.append(util.decorate_message_for_feed(m))
-        return events
+        return util.decorate_messages_for_feed(messages)
 
     @dispatcher.add_method
     def get_chain_block_height():
-        data = blockchain.getinfo()
-        return data['info']['blocks']
+        return blockchain.get_block_height()
 
     @dispatcher.add_method
     def get_chain_address_info(addresses, with_uxtos=True, with_last_txn_hashes=4, with_block_height=False):
@@ -92,10 +129,11 @@ def serve_api(mongo_db, redis_client):
             raise Exception("addresses must be a list of addresses, even if it just contains one address")
         results = []
         if with_block_height:
-            block_height_response = blockchain.getinfo()
-            block_height = block_height_response['info']['blocks'] if block_height_response else None
+            block_height = blockchain.get_block_height()
+        infos = blockchain.getaddressinfos(addresses)
+        utxos = blockchain.listunspents(addresses, address_infos=infos) if with_uxtos else None
         for address in addresses:
-            info = blockchain.getaddressinfo(address)
+            info = infos[address]
             txns = info['transactions']
             del info['transactions']
 
@@ -105,7 +143,7 @@ def serve_api(mongo_db, redis_client):
             if with_block_height: result['block_height'] = block_height
             #^ yeah, hacky...it will be the same block height for each address (we do this to avoid an extra API call to get_block_height)
             if with_uxtos:
-                result['uxtos'] = blockchain.listunspent(address)
+                result['uxtos'] = utxos[address]
             if with_last_txn_hashes:
                 #with last_txns, only show CONFIRMED txns (so skip the first info['unconfirmedTxApperances'] # of txns, if not 0
                 result['last_txns'] = txns[info['unconfirmedTxApperances']:with_last_txn_hashes+info['unconfirmedTxApperances']]
@@ -116,77 +154,19 @@ def serve_api(mongo_db, redis_client):
     def get_chain_txns_status(txn_hashes):
         if not isinstance(txn_hashes, list):
             raise Exception("txn_hashes must be a list of txn hashes, even if it just contains one hash")
-        results = []
-        for tx_hash in txn_hashes:
-            tx_info = blockchain.gettransaction(tx_hash);
-            if tx_info:
-                assert tx_info['txid'] == tx_hash
-                results.append({
-                    'tx_hash': tx_info['txid'],
-                    'blockhash': tx_info.get('blockhash', None), #not provided if not confirmed on network
-                    'confirmations': tx_info.get('confirmations', 0), #not provided if not confirmed on network
-                    'blocktime': tx_info.get('time', None),
-                })
-        return results
+        return blockchain.get_txns_status(txn_hashes)
 
     @dispatcher.add_method
     def get_normalized_balances(addresses):
-        """
-        This call augments counterpartyd's get_balances with a normalized_quantity field. It also will include any owned
-        assets for an address, even if their balance is zero.
-        NOTE: Does not retrieve SCH balance. Use get_address_info for that.
-        """
-        if not isinstance(addresses, list):
-            raise Exception("addresses must be a list of addresses, even if it just contains one address")
-        if not len(addresses):
-            raise Exception("Invalid address list supplied")
-
-        filters = []
-        for address in addresses:
-            filters.append({'field': 'address', 'op': '==', 'value': address})
+        return portfolio.get_normalized_balances(addresses)
 
-        results = []
-        offset = 0
-        limit = 1000
-        while True:
-            result = util.call_jsonrpc_api("get_balances",
-                {'filters': filters, 'filterop': 'or', 'offset': offset, 'limit': limit}, abort_on_error=True)['result']
-            results += result
-
-            if len(result) >= limit:
-                offset += len(result)
-            else:
-                break
-
-        isowner = {}
-        owned_assets = mongo_db.tracked_assets.find( { '$or': [{'owner': a } for a in addresses] }, { '_history': 0, '_id': 0 } )
-        for o in owned_assets:
-          isowner[o['owner'] + o['asset']] = o
-
-        data = []
-        mappings = {}
-        for d in results:
-            if not d['quantity'] and ((d['address'] + d['asset']) not in isowner):
-                continue #don't include balances with a zero asset value
-            asset_info = mongo_db.tracked_assets.find_one({'asset': d['asset']})
-            d['normalized_quantity'] = util_bitcoin.normalize_quantity(d['quantity'], asset_info['divisible'])
-            d['owner'] = (d['address'] + d['asset']) in isowner
-            mappings[d['address'] + d['asset']] = d
-            data.append(d)
-
-        #include any owned assets for each address, even if their balance is zero
-        for key in isowner:
-            if key not in mappings:
-                o = isowner[key]
-                data.append({
-                    'address': o['owner'],
-                    'asset': o['asset'],
-                    'quantity': 0,
-                    'normalized_quantity': 0,
-                    'owner': True,
-                })
+    @dispatcher.add_method
+    def get_portfolio_value(addresses):
+        return portfolio.get_portfolio_value(addresses)
 
-        return data
+    @dispatcher.add_method
+    def get_portfolio_history(addresses, start_ts=None, end_ts=None, interval='day'):
+        return portfolio.get_portfolio_history(addresses, start_ts, end_ts, interval)
 
     def _get_address_history(address, start_block=None, end_block=None):
         address_dict = {}
@@ -356,18 +336,19 @@ def serve_api(mongo_db, redis_client):
         message_indexes = range(max(config.LAST_MESSAGE_INDEX - count, 0) + 1, config.LAST_MESSAGE_INDEX+1)
         messages = util.call_jsonrpc_api("get_messages_by_index",
             { 'message_indexes': message_indexes }, abort_on_error=True)['result']
-        for i in xrange(len(messages)):
-            messages[i] = util.decorate_message_for_feed(messages[i])
-        return messages
+        return util.decorate_messages_for_feed(messages)
 
     @dispatcher.add_method
-    def get_raw_transactions(address, start_ts=None, end_ts=None, limit=500):
+    def get_raw_transactions(address, start_ts=None, end_ts=None, limit=500, before_message_index=None):
         """Gets raw transactions for a particular address
 
         @param address: A single address string
         @param start_ts: The starting date & time. Should be a unix epoch object. If passed as None, defaults to 60 days before the end_date
         @param end_ts: The ending date & time. Should be a unix epoch object. If passed as None, defaults to the current date & time
         @param limit: the maximum number of transactions to return; defaults to ten thousand
+        @param before_message_index: for paging, only return transactions older than this (pass the _message_index of the
+          last transaction of the previous page). Paging is only supported over the block range covered by our address
+          activity index; outside of it, transactions are returned without a _message_index, and passing this raises an error
         @return: Returns the data, ordered from newest txn to oldest. If any limit is applied, it will cut back from the oldest results
         """
         def get_asset_cached(asset, asset_cache):
@@ -388,22 +369,38 @@ def serve_api(mongo_db, redis_client):
             start_dt=datetime.datetime.utcfromtimestamp(start_ts),
             end_dt=datetime.datetime.utcfromtimestamp(end_ts) if now_ts != end_ts else None)
 
-        #make API call to counterpartyd to get all of the data for the specified address
-        txns = []
-        d = _get_address_history(address, start_block=start_block_index, end_block=end_block_index)
-        #mash it all together
-        for category, entries in d.iteritems():
-            if category in ['balances',]:
-                continue
-            for e in entries:
-                e['_category'] = category
-                e = util.decorate_message(e, for_txn_history=True) #DRY
-            txns += entries
-        txns = util.multikeysort(txns, ['-_block_time', '-_tx_index'])
-        txns = txns[0:limit] #TODO: we can trunk before sorting. check if we can use the messages table and use sql order and limit
-        #^ won't be a perfect sort since we don't have tx_indexes for cancellations, but better than nothing
-        #txns.sort(key=operator.itemgetter('block_index'))
-        return txns
+        if address_activity.covers(start_block_index):
+            #serve just the requested page out of our address_activity index
+            txns = address_activity.get_activity(address, start_block_index, end_block_index, limit, before_message_index)
+        else:
+            if before_message_index is not None:
+                #the rows counterpartyd gives us aren't ordered (or identified) by message index
+                raise Exception("Paging with before_message_index is not supported for ranges starting before block %s" % (
+                    address_activity.get_first_block(),))
+            #make API call to counterpartyd to get all of the data for the specified address
+            d = _get_address_history(address, start_block=start_block_index, end_block=end_block_index)
+
+            #each category comes back (roughly) ordered by block_index, so sort each one newest first (which is cheap)
+            # and lazily merge them, stopping as soon as we have enough
+            def history_sort_key(e):
+                block_index = e['block_index'] if 'block_index' in e else e['tx1_block_index']
+                tx_index = e['tx_index'] if 'tx_index' in e else e.get('tx1_index', None)
+                if e['_category'] in ['bet_expirations', 'order_expirations', 'bet_match_expirations', 'order_match_expirations']:
+                    tx_index = 0
+                return (-block_index, -tx_index if tx_index is not None else 1) #rows lacking a tx_index go last in their block
+            seq = itertools.count() #tiebreaker, so that rows themselves are never compared
+            streams = []
+            for category, entries in d.iteritems():
+                if category in ['balances',]:
+                    continue
+                for e in entries:
+                    e['_category'] = category
+                streams.append(((history_sort_key(e), seq.next(), e) for e in sorted(entries, key=history_sort_key)))
+            txns = [e for key, i, e in itertools.islice(heapq.merge(*streams), limit)]
+            #^ won't be a perfect sort since we don't have tx_indexes for cancellations, but better than nothing
+
+        #decorate only what we return
+        return util.decorate_messages(txns, for_txn_history=True)
 
     @dispatcher.add_method
     def get_base_quote_asset(asset1, asset2):
@@ -497,6 +494,11 @@ def serve_api(mongo_db, redis_client):
                 a['extended_image'] = a['extended_description'] = a['extended_website'] = a['extended_pgpsig'] = ''
         return assets_market_info
 
+    @dispatcher.add_method
+    def get_prices(assets, quotes=[config.XCP, config.BTC]):
+        """returns current price data for many assets at once, expressed in SHP and/or SCH"""
+        return prices.get_prices(assets, quotes)
+
     @dispatcher.add_method
     def get_market_info_leaderboard(limit=100):
         """returns market leaderboard data for both the SHP and SCH markets"""
@@ -1406,16 +1408,19 @@ def serve_api(mongo_db, redis_client):
         return dex.get_users_pairs(addresses, max_pairs)
 
     @dispatcher.add_method
-    def get_market_orders(asset1, asset2, addresses=[], min_fee_provided=0.95, max_fee_required=0.95):
-        return dex.get_market_orders(asset1, asset2, addresses, None, min_fee_provided, max_fee_required)
+    def get_market_orders(asset1, asset2, addresses=[], min_fee_provided=0.95, max_fee_required=0.95,
+        depth=dex.MARKET_ORDERS_DEFAULT_DEPTH, limit=dex.MARKET_ORDERS_MAX_LIMIT, before_tx_index=None):
+        return dex.get_market_orders(asset1, asset2, addresses, None, min_fee_provided, max_fee_required,
+            depth=depth, limit=limit, before_tx_index=before_tx_index)
 
     @dispatcher.add_method
-    def get_market_trades(asset1, asset2, addresses=[], limit=100):
-        return dex.get_market_trades(asset1, asset2, addresses, limit)
+    def get_market_trades(asset1, asset2, addresses=[], limit=100, before_block_index=None, before_tx_index=None):
+        return dex.get_market_trades(asset1, asset2, addresses, limit,
+            before_block_index=before_block_index, before_tx_index=before_tx_index)
 
     @dispatcher.add_method
     def get_markets_list():
-        return dex.get_markets_list(mongo_db)
+        return dex.get_markets_list_snapshot(mongo_db)
 
     @dispatcher.add_method
     def get_market_details(asset1, asset2, min_fee_provided=0.95, max_fee_required=0.95):
@@ -1528,7 +1533,7 @@ def serve_api(mongo_db, redis_client):
                 obj_error = jsonrpc.exceptions.JSONRPCInvalidRequest(data="Invalid JSON-RPC 2.0 request format")
                 return flask.Response(obj_error.json.encode(), 200, mimetype='application/json')
 
-            tx_logger.info("***CSP SECURITY --- %s" % data_json)
+            txlog.log_entry("***CSP SECURITY --- %s" % data_json)
             return flask.Response('', 200)
 
         #"ping" counterpartyd to test
@@ -1588,6 +1593,8 @@ def serve_api(mongo_db, redis_client):
         }
         return flask.Response(json.dumps(result), response_code, mimetype='application/json')
 
+    rpc_method_table = _build_rpc_method_table(dispatcher) #(all API methods are registered by now)
+
     @app.route('/', methods=["POST",])
     @app.route('/api/', methods=["POST",])
     def handle_post():
@@ -1618,13 +1625,18 @@ def serve_api(mongo_db, redis_client):
             _set_cors_headers(response)
             return response
 
-        rpc_response = jsonrpc.JSONRPCResponseManager.handle(request_json, dispatcher)
-        rpc_response_json = json.dumps(rpc_response.data, default=util.json_dthandler).encode()
+        rpc_response = _dispatch_rpc_request(rpc_method_table, request_data)
+        if isinstance(rpc_response.get('result', None), util.PreSerializedJSON):
+            #splice the already serialized result in as is
+            rpc_response_json = '{"jsonrpc":"2.0","id":%s,"result":%s}' % (
+                util.JSON_ENCODER.encode(rpc_response['id']), rpc_response['result'])
+        else:
+            rpc_response_json = util.JSON_ENCODER.encode(rpc_response)
 
         #log the request data
         try:
             assert 'method' in request_data
-            tx_logger.info("TRANSACTION --- %s ||| REQUEST: %s ||| RESPONSE: %s" % (request_data['method'], request_json, rpc_response_json))
+            txlog.log_transaction(request_data['method'], request_json, rpc_response_json)
         except Exception as e:
             logging.info("Could not log transaction: Invalid format: %s" % e)
 
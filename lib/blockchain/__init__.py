@@ -1,31 +1,363 @@
 '''
 Proxy API to make queries to popular blockchains explorer
+
+Any number of blockchain services may be configured. Each call goes to the service that is currently fastest (among
+those that are healthy), and if it hasn't answered within its p95 latency, the call is hedged by also sending it to
+the next service (with the first good answer being used). A service that errors out is failed over from right away.
 '''
-import sys
+import copy
+import logging
+import time
+import collections
+
+import gevent
+import gevent.pool
+import gevent.event
 
-from lib import config
+from lib import config, util, util_bitcoin
 import blockr, insight, sochain
 
+SERVICES = {'blockr': blockr, 'insight': insight, 'sochain': sochain}
+SERVICE_STATS_WINDOW = 100 #number of latest calls to each service that its stats are derived from
+SERVICE_MAX_ERROR_RATE = 0.5 #services with a higher error rate than this (over the stats window) are considered unhealthy
+HEDGE_DEFAULT_DELAY = 1.0 #in seconds, the hedge delay used until enough latency samples have been collected
+MIN_LATENCY_SAMPLES = 10 #below this many samples for a method, a service's latency over all of its calls is used instead
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 5.0
+BLOCKCHAIN_SERVICE_CONCURRENCY = 10 #max number of concurrent requests to the blockchain service, per batch of lookups
+
+CONFIRMED_TX_STATUS_CACHE_SIZE = 100000
+#tx_hash -> (status, chain tip block height when fetched), for transactions confirmed deeply enough to never change
+_confirmed_tx_status_cache = util.LRUCache(CONFIRMED_TX_STATUS_CACHE_SIZE)
+
+ADDRESS_CACHE_MAX_AGE = 5 * 60 #in seconds (a backstop, in case the chain tip is not being tracked)
+#address -> {'info': (info, when cached), 'utxos': (UTXOs, when cached)}. cleared on every new chain tip. addresses
+# with unconfirmed transactions are not cached, as what they have pending can change at any time
+_address_cache = {}
+
+#the blockchain service's chain tip, as last seen (kept up to date by events.track_blockchain_tip)
+_tip = {'block_height': None, 'updated_at': None, 'changed_at': None}
+
+#service name -> {'latencies': (of successful and killed calls), 'method_latencies': {method: (the same, per method)},
+# 'errors': (True/False per call), 'calls': ..., 'hedges': ...}
+_service_stats = {}
+
+def _get_stats(name):
+    if name not in _service_stats:
+        _service_stats[name] = {
+            'latencies': collections.deque(maxlen=SERVICE_STATS_WINDOW),
+            'method_latencies': {},
+            'errors': collections.deque(maxlen=SERVICE_STATS_WINDOW),
+            'calls': 0,
+            'hedges': 0,
+        }
+    return _service_stats[name]
+
+def _record_latency(name, method, latency):
+    stats = _get_stats(name)
+    stats['latencies'].append(latency)
+    stats['method_latencies'].setdefault(method, collections.deque(maxlen=SERVICE_STATS_WINDOW)).append(latency)
+
+def _get_latencies(name, method):
+    """The service's latency samples for the method (as a cheap getinfo and a large multi-address lookup take very
+    different times), or for all of its calls, if it doesn't have enough samples for the method yet"""
+    stats = _get_stats(name)
+    method_latencies = stats['method_latencies'].get(method, ())
+    return method_latencies if len(method_latencies) >= MIN_LATENCY_SAMPLES else stats['latencies']
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[int(round(percentile * (len(values) - 1)))]
+
+def _error_rate(stats):
+    return float(sum(stats['errors'])) / len(stats['errors']) if stats['errors'] else 0.0
+
+def _hedge_delay(name, method):
+    latencies = _get_latencies(name, method)
+    if len(latencies) < MIN_LATENCY_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return min(max(_percentile(latencies, 0.95), HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+def _ranked_services(method):
+    """The configured services implementing the method, healthy ones first (fastest first, where services without
+    latency samples yet come first, so that they get some), then unhealthy ones (least erroring first)"""
+    names = [name for name in config.BLOCKCHAIN_SERVICE_NAMES if hasattr(SERVICES[name], method)]
+    def rank(name):
+        stats = _get_stats(name)
+        error_rate = _error_rate(stats)
+        if error_rate > SERVICE_MAX_ERROR_RATE:
+            return (1, error_rate)
+        latencies = _get_latencies(name, method)
+        return (0, _percentile(latencies, 0.5) if latencies else 0)
+    return sorted(names, key=rank)
+
+def _timed_call(name, method, *args):
+    stats = _get_stats(name)
+    stats['calls'] += 1
+    start = time.time()
+    failed = False
+    try:
+        result = getattr(SERVICES[name], method)(*args)
+    except Exception, e:
+        failed = True
+        stats['errors'].append(True)
+        logging.debug("Blockchain service %s: %s%s failed: %s" % (name, method, args, e))
+        raise
+    finally:
+        #a call killed for losing a hedge (with GreenletExit) is recorded as taking as long as it had run (at least): as
+        # those are the slow calls, leaving them out would drag the p95, and so the hedge delay, ever further down
+        if not failed:
+            _record_latency(name, method, time.time() - start)
+    stats['errors'].append(False)
+    return result
+
+def _call(method, *args):
+    names = _ranked_services(method)
+    if not names:
+        raise Exception("No configured blockchain service supports %s" % method)
+    pending = []
+    last_error = None
+    for i, name in enumerate(names):
+        if i > 0: _get_stats(names[i - 1])['hedges'] += 1
+        pending.append(gevent.spawn(_timed_call, name, method, *args))
+        is_last = i == len(names) - 1
+        while pending:
+            #wait for any of the calls in flight, up to the hedge delay before also trying the next service
+            ready = gevent.wait(pending, timeout=None if is_last else _hedge_delay(name, method), count=1)
+            if not ready:
+                break
+            for greenlet in ready:
+                pending.remove(greenlet)
+                if greenlet.successful():
+                    gevent.killall(pending, block=False)
+                    return greenlet.value
+                last_error = greenlet.exception
+            if not is_last:
+                break #fail over to the next service right away
+    raise last_error
+
+def get_service_stats():
+    """Returns call count, hedge count, error rate and p50/p95 latency (over the stats window) per service, along with
+    p50/p95 latency per method"""
+    service_stats = {}
+    for name in config.BLOCKCHAIN_SERVICE_NAMES:
+        stats = _get_stats(name)
+        service_stats[name] = {
+            'calls': stats['calls'],
+            'hedges': stats['hedges'],
+            'error_rate': _error_rate(stats),
+            'latency_p50': _percentile(stats['latencies'], 0.5) if stats['latencies'] else None,
+            'latency_p95': _percentile(stats['latencies'], 0.95) if stats['latencies'] else None,
+            'methods': dict([(method, {
+                'latency_p50': _percentile(latencies, 0.5),
+                'latency_p95': _percentile(latencies, 0.95),
+            }) for method, latencies in stats['method_latencies'].iteritems() if latencies]),
+        }
+    return service_stats
+
 # http://test.insight.is/api/sync
 def check():
-    return sys.modules['lib.blockchain.{}'.format(config.BLOCKCHAIN_SERVICE_NAME)].check()
+    """Checks every configured service, failing only if none of them are usable"""
+    errors = []
+    for name in config.BLOCKCHAIN_SERVICE_NAMES:
+        try:
+            _timed_call(name, 'check')
+        except Exception, e:
+            logging.warn("Blockchain service %s check failed: %s" % (name, e))
+            errors.append("%s: %s" % (name, e))
+    logging.info("Blockchain service stats: %s" % get_service_stats())
+    logging.info("HTTP client stats: %s" % util.get_http_client_stats())
+    if len(errors) == len(config.BLOCKCHAIN_SERVICE_NAMES):
+        raise Exception('; '.join(errors))
 
 # http://test.insight.is/api/status?q=getInfo
 def getinfo():
-    return sys.modules['lib.blockchain.{}'.format(config.BLOCKCHAIN_SERVICE_NAME)].getinfo()
+    return _call('getinfo')
 
 # example: http://test.insight.is/api/addr/mmvP3mTe53qxHdPqXEvdu8WdC7GfQ2vmx5/utxo
 def listunspent(address):
-    return sys.modules['lib.blockchain.{}'.format(config.BLOCKCHAIN_SERVICE_NAME)].listunspent(address)
+    return _call('listunspent', address)
+
+def listunspent_multi(addresses):
+    return _call('listunspent_multi', addresses)
 
 # example: http://test.insight.is/api/addr/mmvP3mTe53qxHdPqXEvdu8WdC7GfQ2vmx5
 def getaddressinfo(address):
-    return sys.modules['lib.blockchain.{}'.format(config.BLOCKCHAIN_SERVICE_NAME)].getaddressinfo(address)
+    return _call('getaddressinfo', address)
 
 # example: http://test.insight.is/api/tx/c6b5368c5a256141894972fbd02377b3894aa0df7c35fab5e0eca90de064fdc1
 def gettransaction(tx_hash):
-    return sys.modules['lib.blockchain.{}'.format(config.BLOCKCHAIN_SERVICE_NAME)].gettransaction(tx_hash)
+    return _call('gettransaction', tx_hash)
+
+def _get_input_pubkey(tx):
+    """Returns the pubkey (hex) out of the first input's script of the transaction, if any"""
+    vin = tx['vin'][0]
+    script_asm = vin['scriptSig']['asm'] if 'scriptSig' in vin else vin.get('script', '') #(sochain gives just the asm)
+    script_parts = script_asm.split(' ')
+    return script_parts[1] if len(script_parts) > 1 else None
 
 def get_pubkey_for_address(address):
-    """attempts to get the public key from an address. the address must have at least made one transaction"""
-    return sys.modules['lib.blockchain.{}'.format(config.BLOCKCHAIN_SERVICE_NAME)].get_pubkey_for_address(address)
+    """attempts to get the public key from an address. the address must have at least made one transaction.
+    Found pubkeys are stored permanently (in the address_pubkeys collection), as an address' pubkey never changes"""
+    mongo_db = config.mongo_db
+    cached = mongo_db.address_pubkeys.find_one({'address': address})
+    if cached:
+        return cached['pubkey']
+
+    #first, get a list of transactions for the address
+    address_info = getaddressinfo(address)
+    #if no transactions, we can't get the pubkey
+    if not address_info or not address_info['transactions']:
+        return None
+
+    #go through the address' transactions concurrently, extracting the pubkey of each one's first input, and stopping
+    # at the first one that reduces down to the given address
+    def get_matching_pubkey(tx_hash):
+        try:
+            tx = gettransaction(tx_hash)
+            pubkey_hex = _get_input_pubkey(tx) if tx else None
+            if pubkey_hex and util_bitcoin.pubkey_to_address(pubkey_hex) == address:
+                return pubkey_hex
+        except Exception, e:
+            logging.debug("Could not check transaction %s for the pubkey of %s: %s" % (tx_hash, address, e))
+        return None
+    pool = gevent.pool.Pool(BLOCKCHAIN_SERVICE_CONCURRENCY)
+    found = gevent.event.AsyncResult() #set to the pubkey on the first match (or to None once all lookups are done)
+    def check_transaction(tx_hash):
+        pubkey_hex = get_matching_pubkey(tx_hash)
+        if pubkey_hex and not found.ready():
+            found.set(pubkey_hex)
+    def spawn_lookups():
+        for tx_hash in address_info['transactions']:
+            pool.spawn(check_transaction, tx_hash) #(waits for a free slot in the pool)
+        pool.join()
+        if not found.ready():
+            found.set(None)
+    spawner = gevent.spawn(spawn_lookups)
+    try:
+        pubkey_hex = found.get()
+    finally:
+        #cancel the lookups yet to start, then those still in flight
+        spawner.kill()
+        pool.kill()
+
+    if pubkey_hex:
+        mongo_db.address_pubkeys.update({'address': address}, {'address': address, 'pubkey': pubkey_hex}, upsert=True)
+    return pubkey_hex
+
+def invalidate_address_cache(addresses=None):
+    """Drops the cached info and UTXOs of the specified addresses (or of all addresses, if none are specified)"""
+    if addresses is None:
+        _address_cache.clear()
+    for address in addresses or []:
+        _address_cache.pop(address, None)
+
+def _lookup_addresses(addresses, field, lookup_one, lookup_many=None, on_cache_hit=None, cacheable=None):
+    cache = _address_cache
+    min_cached_at = time.time() - ADDRESS_CACHE_MAX_AGE
+    results = dict([(address, cache[address][field][0]) for address in addresses
+        if field in cache.get(address, {}) and cache[address][field][1] >= min_cached_at])
+    cache_hits = set(results.keys())
+    missing = [address for address in set(addresses) if address not in results]
+    if missing:
+        if lookup_many:
+            found = lookup_many(missing)
+        else:
+            pool = gevent.pool.Pool(BLOCKCHAIN_SERVICE_CONCURRENCY)
+            found = dict(zip(missing, pool.map(lookup_one, missing)))
+        for address in missing:
+            results[address] = found.get(address, None)
+            if results[address] is not None and (not cacheable or cacheable(address, results[address])):
+                #(failed lookups are never held on to)
+                cache.setdefault(address, {})[field] = (results[address], time.time())
+    #callers are free to modify what they get back
+    results = dict([(address, copy.deepcopy(results[address])) for address in addresses])
+    if on_cache_hit:
+        for address in cache_hits:
+            on_cache_hit(results[address])
+    return results
+
+def _has_unconfirmed(info):
+    return bool(info.get('unconfirmedTxApperances') or info.get('unconfirmedBalanceSat'))
+
+def getaddressinfos(addresses):
+    """Returns a dict of address -> getaddressinfo result for the specified addresses, looking up those not cached
+    (since the last new block) concurrently. Addresses with unconfirmed transactions are always looked up"""
+    return _lookup_addresses(addresses, 'info', getaddressinfo,
+        cacheable=lambda address, info: not _has_unconfirmed(info))
+
+def listunspents(addresses, address_infos=None):
+    """Returns a dict of address -> listunspent result for the specified addresses, looking up those not cached (since
+    the last new block) concurrently, or with multi-address requests where the blockchain service supports them. UTXOs
+    served from the cache have confirmationsFromCache set.
+    The UTXOs of addresses with unconfirmed transactions (as per address_infos, which are looked up if not passed in)
+    are never cached or served from the cache, as they may be in the middle of being spent"""
+    if address_infos is None:
+        address_infos = getaddressinfos(addresses)
+    pending = set([address for address in addresses
+        if not address_infos.get(address) or _has_unconfirmed(address_infos[address])])
+    invalidate_address_cache(pending)
+    def mark_from_cache(utxos):
+        for utxo in utxos or []:
+            utxo['confirmationsFromCache'] = True
+    return _lookup_addresses(addresses, 'utxos', listunspent,
+        listunspent_multi if _ranked_services('listunspent_multi') else None, on_cache_hit=mark_from_cache,
+        cacheable=lambda address, utxos: address not in pending and all(utxo.get('confirmations') for utxo in utxos))
+
+def get_txns_status(tx_hashes):
+    """Returns the status (block hash, block time and confirmations) of each of the specified transactions known to the
+    blockchain service. Transactions with over MAX_REORG_NUM_BLOCKS confirmations are kept in a permanent cache (with
+    their confirmations brought up to date from the chain tip); the rest are fetched concurrently"""
+    statuses = {}
+    block_height = get_block_height() #(None if the tip is unknown, in which case the cache can't be used)
+    for tx_hash in tx_hashes:
+        cached = _confirmed_tx_status_cache.get(tx_hash)
+        if cached and block_height is not None:
+            status, fetched_at_block_height = cached
+            statuses[tx_hash] = dict(status, confirmations=status['confirmations'] + max(block_height - fetched_at_block_height, 0))
+
+    to_fetch = [tx_hash for tx_hash in set(tx_hashes) if tx_hash not in statuses]
+    if to_fetch:
+        pool = gevent.pool.Pool(BLOCKCHAIN_SERVICE_CONCURRENCY)
+        for tx_hash, tx_info in zip(to_fetch, pool.map(gettransaction, to_fetch)):
+            if not tx_info:
+                continue
+            assert tx_info['txid'] == tx_hash
+            statuses[tx_hash] = {
+                'tx_hash': tx_info['txid'],
+                'blockhash': tx_info.get('blockhash', None), #not provided if not confirmed on network
+                'confirmations': tx_info.get('confirmations', 0), #not provided if not confirmed on network
+                'blocktime': tx_info.get('time', None),
+            }
+            if statuses[tx_hash]['confirmations'] > config.MAX_REORG_NUM_BLOCKS and block_height is not None:
+                _confirmed_tx_status_cache.set(tx_hash, (statuses[tx_hash], block_height))
+    return [dict(statuses[tx_hash]) for tx_hash in tx_hashes if tx_hash in statuses]
+
+def update_tip():
+    """Fetches the chain tip from the blockchain service, returning True if it has advanced. A lower block height (as
+    may come from a lagging service, with several configured) is ignored"""
+    block_height_response = getinfo()
+    block_height = block_height_response['info']['blocks'] if block_height_response else None
+    now = time.time()
+    _tip['updated_at'] = now
+    if block_height is None or block_height == _tip['block_height']:
+        return False
+    if _tip['block_height'] is not None and block_height < _tip['block_height']:
+        logging.debug("Ignoring chain tip at block %i from the blockchain service, behind the last seen tip at block %i" % (
+            block_height, _tip['block_height']))
+        return False
+    _tip['block_height'] = block_height
+    _tip['changed_at'] = now
+    config.BLOCKCHAIN_SERVICE_LAST_BLOCK = block_height
+    invalidate_address_cache() #balances, UTXOs and their confirmations have all changed
+    return True
+
+def get_tip():
+    """Returns the last seen chain tip, as a dict with block_height, updated_at (when last checked) and changed_at (when
+    last changed), as epoch timestamps. It is fetched now only if it hasn't been yet"""
+    if _tip['block_height'] is None:
+        update_tip()
+    return dict(_tip)
+
+def get_block_height():
+    return get_tip()['block_height']
@@ -3,11 +3,13 @@ http://insight.bitpay.com/
 '''
 import logging
 
-from lib import config, util, util_bitcoin
+from lib import config, util
+
+MAX_ADDRESSES_PER_REQUEST = 50 #keeps the request URL for multi-address calls to a sane length
 
 def get_host():
-    if config.BLOCKCHAIN_SERVICE_CONNECT:
-        return config.BLOCKCHAIN_SERVICE_CONNECT
+    if config.BLOCKCHAIN_SERVICE_CONNECTS.get('insight', None):
+        return config.BLOCKCHAIN_SERVICE_CONNECTS['insight']
     else:
         return 'http://localhost:3001' if config.TESTNET else 'http://localhost:3000'
 
@@ -26,25 +28,16 @@ def getinfo():
 def listunspent(address):
     return util.get_url(get_host() + '/api/addr/' + address + '/utxo/', abort_on_error=True)
 
+def listunspent_multi(addresses):
+    """Returns a dict of address -> UTXOs, for the specified addresses, via insight's multi-address endpoint"""
+    utxos = dict([(address, []) for address in addresses])
+    for i in xrange(0, len(addresses), MAX_ADDRESSES_PER_REQUEST):
+        for utxo in util.get_url(get_host() + '/api/addrs/' + ','.join(addresses[i:i + MAX_ADDRESSES_PER_REQUEST]) + '/utxo', abort_on_error=True):
+            utxos.setdefault(utxo['address'], []).append(utxo)
+    return utxos
+
 def getaddressinfo(address):
     return util.get_url(get_host() + '/api/addr/' + address + '/', abort_on_error=True)
 
 def gettransaction(tx_hash):
     return util.get_url(get_host() + '/api/tx/' + tx_hash + '/', abort_on_error=False)
-
-def get_pubkey_for_address(address):
-    #first, get a list of transactions for the address
-    address_info = getaddressinfo(address)
-
-    #if no transactions, we can't get the pubkey
-    if not address_info['transactions']:
-        return None
-    
-    #for each transaction we got back, extract the vin, pubkey, go through, convert it to binary, and see if it reduces down to the given address
-    for tx_id in address_info['transactions']:
-        #parse the pubkey out of the first sent transaction
-        tx = gettransaction(tx_id)
-        pubkey_hex = tx['vin'][0]['scriptSig']['asm'].split(' ')[1]
-        if util_bitcoin.pubkey_to_address(pubkey_hex) == address:
-            return pubkey_hex
-    return None
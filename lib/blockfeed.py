@@ -15,11 +15,13 @@ import time
 import pymongo
 import gevent
 
-from lib import config, util, events, blockchain, util_bitcoin
-from lib.components import assets, betting
+from lib import config, util, events, blockchain, util_bitcoin, util_log
+from lib.components import assets, assets_trading, betting, dex, pricing_graph, address_activity
 
 D = decimal.Decimal
 
+ingest_logger = logging.getLogger(util_log.INGEST_LOGGER_NAME) #per-message logging (dropped while catching up)
+
 def process_cpd_blockfeed(zmq_publisher_eventfeed):
     LATEST_BLOCK_INIT = {'block_index': config.BLOCK_FIRST, 'block_time': None, 'block_hash': None}
     mongo_db = config.mongo_db
@@ -30,6 +32,8 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         mongo_db.tracked_assets.drop()
         mongo_db.trades.drop()
         mongo_db.balance_changes.drop()
+        mongo_db.current_balances.drop()
+        mongo_db.address_activity.drop()
         mongo_db.asset_market_info.drop()
         mongo_db.asset_marketcap_history.drop()
         mongo_db.pair_market_info.drop()
@@ -38,6 +42,9 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         mongo_db.transaction_stats.drop()
         mongo_db.feeds.drop()
         mongo_db.wallet_stats.drop()
+        assets_trading.invalidate_market_price_summary()
+        pricing_graph.reset()
+        dex.reset_pair_prices()
         
         #create/update default app_config object
         mongo_db.app_config.update({}, {
@@ -47,6 +54,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         'counterpartyd_db_version_minor': None,
         'counterpartyd_running_testnet': None,
         'last_block_assets_compiled': config.BLOCK_FIRST, #for asset data compilation in events.py (resets on reparse as well)
+        'address_activity_first_block': config.BLOCK_FIRST, #address_activity is complete from this block on
         }, upsert=True)
         app_config = mongo_db.app_config.find()[0]
         
@@ -81,9 +89,25 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         logging.warn("Pruning to block %i ..." % (max_block_index))        
         mongo_db.processed_blocks.remove({"block_index": {"$gt": max_block_index}})
         mongo_db.balance_changes.remove({"block_index": {"$gt": max_block_index}})
+        #roll back the current balance of each (address, asset) pair changed after the block we are pruning back to
+        for bal in mongo_db.current_balances.find({"block_index": {"$gt": max_block_index}}):
+            last_bal_change = mongo_db.balance_changes.find_one({'address': bal['address'], 'asset': bal['asset']},
+                sort=[("block_index", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+            if last_bal_change:
+                mongo_db.current_balances.update({'_id': bal['_id']}, {'$set': {
+                    'quantity': last_bal_change['new_balance'],
+                    'normalized_quantity': last_bal_change['new_balance_normalized'],
+                    'block_index': last_bal_change['block_index'],
+                }})
+            else:
+                mongo_db.current_balances.remove({'_id': bal['_id']})
         mongo_db.trades.remove({"block_index": {"$gt": max_block_index}})
         mongo_db.asset_marketcap_history.remove({"block_index": {"$gt": max_block_index}})
         mongo_db.transaction_stats.remove({"block_index": {"$gt": max_block_index}})
+        address_activity.prune(mongo_db, max_block_index)
+        assets_trading.invalidate_market_price_summary() #trades were removed
+        pricing_graph.reset()
+        dex.reset_pair_prices()
         
         #to roll back the state of the tracked asset, dive into the history object for each asset that has
         # been updated on or after the block that we are pruning back to
@@ -141,11 +165,15 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             }
             
             mongo_db.mempool.insert(tx)
+            #the balances and UTXOs of the addresses involved are changing (the blockchain module doesn't cache addresses
+            # with unconfirmed transactions at all, but these may have been cached just before this one came in)
+            bindings = json.loads(new_tx['bindings'])
+            blockchain.invalidate_address_cache([bindings[col] for col in ('source', 'destination') if bindings.get(col)])
             del(tx['_id'])
             tx['_category'] = tx['category']
             tx['_message_index'] = 'mempool'
             logging.debug("Spotted mempool tx: %s" % tx)
-            zmq_publisher_eventfeed.send_json(tx)
+            util.publish_event(zmq_publisher_eventfeed, tx)
             
     def clean_mempool_tx():
         """clean mempool transactions older than MAX_REORG_NUM_BLOCKS blocks"""
@@ -179,6 +207,10 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         #remove any data we have for blocks higher than this (would happen if counterblockd or mongo died
         # or errored out while processing a block)
         my_latest_block = prune_my_stale_blocks(my_latest_block['block_index'])
+        if 'address_activity_first_block' not in app_config:
+            #database predates the address_activity index, which will be complete from the next block on
+            app_config['address_activity_first_block'] = my_latest_block['block_index'] + 1
+            mongo_db.app_config.update({}, {'$set': {'address_activity_first_block': app_config['address_activity_first_block']}})
 
     #start polling counterpartyd for new blocks    
     while True:
@@ -278,15 +310,18 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                     logging.warn("BUG: IGNORED old RAW message %s: %s ..." % (msg['message_index'], msg))
                     continue
                     
-                logging.info("Received message %s: %s ..." % (msg['message_index'], msg))
+                ingest_logger.info("Received message %s: %s ...", msg['message_index'], msg)
                 
+                #index history rows per address (invalid ones included, as they are part of an address' history)
+                address_activity.index_message(mongo_db, msg, msg_data, cur_block_index)
+
                 #don't process invalid messages, but do forward them along to clients
                 status = msg_data.get('status', 'valid').lower()
                 if status.startswith('invalid'):
                     #(but don't forward along while we're catching up)
                     if last_processed_block['block_index'] - my_latest_block['block_index'] < config.MAX_REORG_NUM_BLOCKS:
                         event = util.decorate_message_for_feed(msg, msg_data=msg_data)
-                        zmq_publisher_eventfeed.send_json(event)
+                        util.publish_event(zmq_publisher_eventfeed, event)
                 
                     config.LAST_MESSAGE_INDEX = msg['message_index']
                     continue
@@ -318,12 +353,16 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                     if last_processed_block['block_index'] - my_latest_block['block_index'] < config.MAX_REORG_NUM_BLOCKS:
                         msg_data['_last_message_index'] = config.LAST_MESSAGE_INDEX
                         event = util.decorate_message_for_feed(msg, msg_data=msg_data)
-                        zmq_publisher_eventfeed.send_json(event)
+                        util.publish_event(zmq_publisher_eventfeed, event)
                     break #break out of inner loop
                 
                 #track assets
                 if msg['category'] == 'issuances':
                     assets.parse_issuance(mongo_db, msg_data, cur_block_index, cur_block)
+
+                #track the latest prices of dex pairs
+                if msg['category'] == 'order_matches' and msg['command'] == 'insert':
+                    dex.track_order_match(msg_data, cur_block['block_time'])
                 
                 #track balance changes for each address
                 bal_change = None
@@ -351,7 +390,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                         last_bal_change['new_balance'] += quantity
                         last_bal_change['new_balance_normalized'] += quantity_normalized
                         mongo_db.balance_changes.save(last_bal_change)
-                        logging.info("Procesed %s bal change (UPDATED) from tx %s :: %s" % (actionName, msg['message_index'], last_bal_change))
+                        ingest_logger.info("Procesed %s bal change (UPDATED) from tx %s :: %s", actionName, msg['message_index'], last_bal_change)
                         bal_change = last_bal_change
                     else: #new balance change record for this block
                         bal_change = {
@@ -365,7 +404,14 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                             'new_balance_normalized': last_bal_change['new_balance_normalized'] + quantity_normalized if last_bal_change else quantity_normalized,
                         }
                         mongo_db.balance_changes.insert(bal_change)
-                        logging.info("Procesed %s bal change from tx %s :: %s" % (actionName, msg['message_index'], bal_change))
+                        ingest_logger.info("Procesed %s bal change from tx %s :: %s", actionName, msg['message_index'], bal_change)
+
+                    #materialize the resulting balance, for serving get_normalized_balances
+                    mongo_db.current_balances.update({'address': address, 'asset': asset_info['asset']}, {'$set': {
+                        'quantity': bal_change['new_balance'],
+                        'normalized_quantity': util_bitcoin.normalize_quantity(bal_change['new_balance'], asset_info['divisible']),
+                        'block_index': cur_block_index,
+                    }}, upsert=True)
                 
                 #book trades
                 if (msg['category'] == 'order_matches'
@@ -393,7 +439,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                     #don't create trade records from order matches with BTC that are under the dust limit
                     if    (order_match['forward_asset'] == config.BTC and order_match['forward_quantity'] <= config.ORDER_BTC_DUST_LIMIT_CUTOFF) \
                        or (order_match['backward_asset'] == config.BTC and order_match['backward_quantity'] <= config.ORDER_BTC_DUST_LIMIT_CUTOFF):
-                        logging.debug("Order match %s ignored due to %s under dust limit." % (order_match['tx0_hash'] + order_match['tx1_hash'], config.BTC))
+                        ingest_logger.debug("Order match %s ignored due to %s under dust limit.", order_match['tx0_hash'] + order_match['tx1_hash'], config.BTC)
                         continue
 
                     #take divisible trade quantities to floating point
@@ -425,7 +471,9 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                             D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
 
                     mongo_db.trades.insert(trade)
-                    logging.info("Procesed Trade from tx %s :: %s" % (msg['message_index'], trade))
+                    assets_trading.invalidate_market_price_summary(base_asset, quote_asset)
+                    pricing_graph.mark_pair_dirty(base_asset, quote_asset)
+                    ingest_logger.info("Procesed Trade from tx %s :: %s", msg['message_index'], trade)
                 
                 #broadcast
                 if msg['category'] == 'broadcasts':
@@ -437,7 +485,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 if last_processed_block['block_index'] - my_latest_block['block_index'] < config.MAX_REORG_NUM_BLOCKS:
                     #send out the message to listening clients
                     event = util.decorate_message_for_feed(msg, msg_data=msg_data)
-                    zmq_publisher_eventfeed.send_json(event)
+                    util.publish_event(zmq_publisher_eventfeed, event)
 
                 #this is the last processed message index
                 config.LAST_MESSAGE_INDEX = msg['message_index']
@@ -451,11 +499,8 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             mongo_db.processed_blocks.insert(new_block)
             my_latest_block = new_block
             config.CURRENT_BLOCK_INDEX = cur_block_index
-            #get the current blockchain service block
-            if config.BLOCKCHAIN_SERVICE_LAST_BLOCK == 0 or config.BLOCKCHAIN_SERVICE_LAST_BLOCK - config.CURRENT_BLOCK_INDEX < config.MAX_REORG_NUM_BLOCKS:
-                #update as CURRENT_BLOCK_INDEX catches up with BLOCKCHAIN_SERVICE_LAST_BLOCK and/or surpasses it (i.e. if blockchain service gets behind for some reason)
-                block_height_response = blockchain.getinfo()
-                config.BLOCKCHAIN_SERVICE_LAST_BLOCK = block_height_response['info']['blocks'] if block_height_response else 0
+            #get the current blockchain service block (as tracked by events.track_blockchain_tip)
+            config.BLOCKCHAIN_SERVICE_LAST_BLOCK = blockchain.get_block_height() or 0
             logging.info("Block: %i (message_index height=%s) (blockchain latest block=%s)" % (config.CURRENT_BLOCK_INDEX,
                 config.LAST_MESSAGE_INDEX if config.LAST_MESSAGE_INDEX != -1 else '???',
                 config.BLOCKCHAIN_SERVICE_LAST_BLOCK if config.BLOCKCHAIN_SERVICE_LAST_BLOCK else '???'))
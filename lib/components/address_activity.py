@@ -0,0 +1,104 @@
+"""
+Maintains the address_activity collection: an index of (address, block_index, tx_index, category, message_index) for
+every counterpartyd message that creates a history row touching an address. This lets get_raw_transactions page
+through an address' history (newest first) without pulling its entire history out of counterpartyd.
+"""
+import json
+import logging
+
+import pymongo
+
+from lib import config, util
+
+#the history categories returned by get_raw_transactions
+HISTORY_CATEGORIES = ['debits', 'credits', 'burns', 'sends', 'orders', 'order_matches', 'btcpays', 'issuances',
+    'broadcasts', 'bets', 'bet_matches', 'dividends', 'cancels', 'callbacks', 'bet_expirations', 'order_expirations',
+    'bet_match_expirations', 'order_match_expirations']
+#address columns that also tie a row to an address, beyond those of util.get_address_cols_for_entity
+EXTRA_ADDRESS_COLS = {
+    'sends': ['destination',],
+    'btcpays': ['destination',],
+    'issuances': ['source',],
+    'bet_expirations': ['source',],
+    'order_expirations': ['source',],
+}
+#for categories whose rows are updated after being inserted (e.g. an order's status), the table's key column.
+# rows of these categories are refreshed from counterpartyd when served, as the message data is as of insertion
+UPDATABLE_CATEGORIES = {
+    'orders': 'tx_hash',
+    'bets': 'tx_hash',
+    'order_matches': 'id',
+    'bet_matches': 'id',
+}
+
+def index_message(mongo_db, msg, msg_data, block_index):
+    """Records the addresses touched by the given message (if it is a history row insert)"""
+    if msg['command'] != 'insert' or msg['category'] not in HISTORY_CATEGORIES:
+        return
+    addresses = set()
+    for col in util.get_address_cols_for_entity(msg['category']) + EXTRA_ADDRESS_COLS.get(msg['category'], []):
+        if msg_data.get(col):
+            addresses.add(msg_data[col])
+    if not addresses:
+        return
+    tx_index = msg_data['tx_index'] if 'tx_index' in msg_data else msg_data.get('tx1_index', None)
+    mongo_db.address_activity.insert([{
+        'address': address,
+        'block_index': block_index,
+        'tx_index': tx_index,
+        'category': msg['category'],
+        'message_index': msg['message_index'],
+    } for address in addresses])
+
+def prune(mongo_db, max_block_index):
+    mongo_db.address_activity.remove({"block_index": {"$gt": max_block_index}})
+
+def get_first_block():
+    """Returns the block from which the index has been maintained (or None, if it hasn't been yet)"""
+    app_config = config.mongo_db.app_config.find_one()
+    return app_config.get('address_activity_first_block', None) if app_config else None
+
+def covers(start_block_index):
+    """Returns True if the index has been maintained from at or before the specified block"""
+    first_block = get_first_block()
+    return first_block is not None and first_block <= start_block_index
+
+def get_activity(address, start_block_index, end_block_index, limit, before_message_index=None):
+    """Returns up to limit of the address' history rows within the block range (newest first, and older than
+    before_message_index, if specified). Each row has _category and _message_index fields set, but is not decorated.
+    """
+    mongo_db = config.mongo_db
+    query = {'address': address, 'block_index': {'$gte': start_block_index, '$lte': end_block_index}}
+    if before_message_index is not None:
+        query['message_index'] = {'$lt': before_message_index}
+    activity = list(mongo_db.address_activity.find(query, {'_id': 0, 'category': 1, 'message_index': 1}
+        ).sort('message_index', pymongo.DESCENDING).limit(limit))
+    if not activity:
+        return []
+
+    #get the row data for just this page of messages, in one call
+    messages = util.call_jsonrpc_api("get_messages_by_index",
+        {'message_indexes': [a['message_index'] for a in activity]}, abort_on_error=True)['result']
+    messages = dict([(m['message_index'], m) for m in messages])
+    rows = []
+    for a in activity:
+        if a['message_index'] not in messages:
+            logging.warn("address_activity: message %s not returned by counterpartyd" % a['message_index'])
+            continue
+        row = json.loads(messages[a['message_index']]['bindings'])
+        row['_category'] = a['category']
+        row['_message_index'] = a['message_index']
+        rows.append(row)
+
+    #bring rows that may have been updated since their insertion up to date, with one query per table
+    for category, key_col in UPDATABLE_CATEGORIES.iteritems():
+        keys = [r[key_col] for r in rows if r['_category'] == category and key_col in r]
+        if not keys: continue
+        current_rows = util.call_jsonrpc_api('sql', {
+            'query': 'SELECT * FROM {} WHERE {} IN ({})'.format(category, key_col, ','.join(['?' for k in keys])),
+            'bindings': keys}, abort_on_error=True)['result']
+        current_rows = dict([(r[key_col], r) for r in current_rows])
+        for row in rows:
+            if row['_category'] == category and row.get(key_col) in current_rows:
+                row.update(current_rows[row[key_col]])
+    return rows
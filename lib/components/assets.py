@@ -5,11 +5,13 @@ import base64
 import json
 from datetime import datetime
 
-from lib import config, util, util_bitcoin
+from lib import config, util, util_bitcoin, util_log
 
 ASSET_MAX_RETRY = 3
 D = decimal.Decimal
 
+ingest_logger = logging.getLogger(util_log.INGEST_LOGGER_NAME)
+
 def parse_issuance(db, message, cur_block_index, cur_block):
     def modify_extended_asset_info(asset, description):
         """adds an asset to asset_extended_info collection if the description is a valid json link. or, if the link
@@ -47,7 +49,7 @@ def parse_issuance(db, message, cur_block_index, cur_block):
                 'locked': True,
              },
              "$push": {'_history': tracked_asset } }, upsert=False)
-        logging.info("Locking asset %s" % (message['asset'],))
+        ingest_logger.info("Locking asset %s", message['asset'])
     elif message['transfer']: #transfer asset
         assert tracked_asset is not None
         db.tracked_assets.update(
@@ -59,7 +61,7 @@ def parse_issuance(db, message, cur_block_index, cur_block):
                 'owner': message['issuer'],
              },
              "$push": {'_history': tracked_asset } }, upsert=False)
-        logging.info("Transferring asset %s to address %s" % (message['asset'], message['issuer']))
+        ingest_logger.info("Transferring asset %s to address %s", message['asset'], message['issuer'])
     elif message['quantity'] == 0 and tracked_asset is not None: #change description
         db.tracked_assets.update(
             {'asset': message['asset']},
@@ -71,7 +73,7 @@ def parse_issuance(db, message, cur_block_index, cur_block):
              },
              "$push": {'_history': tracked_asset } }, upsert=False)
         modify_extended_asset_info(message['asset'], message['description'])
-        logging.info("Changing description for asset %s to '%s'" % (message['asset'], message['description']))
+        ingest_logger.info("Changing description for asset %s to '%s'", message['asset'], message['description'])
     else: #issue new asset or issue addition qty of an asset
         if not tracked_asset: #new issuance
             tracked_asset = {
@@ -91,7 +93,7 @@ def parse_issuance(db, message, cur_block_index, cur_block):
                 '_history': [] #to allow for block rollbacks
             }
             db.tracked_assets.insert(tracked_asset)
-            logging.info("Tracking new asset: %s" % message['asset'])
+            ingest_logger.info("Tracking new asset: %s", message['asset'])
             modify_extended_asset_info(message['asset'], message['description'])
         else: #issuing additional of existing asset
             assert tracked_asset is not None
@@ -107,8 +109,8 @@ def parse_issuance(db, message, cur_block_index, cur_block):
                      'total_issued_normalized': util_bitcoin.normalize_quantity(message['quantity'], message['divisible'])
                  },
                  "$push": {'_history': tracked_asset} }, upsert=False)
-            logging.info("Adding additional %s quantity for asset %s" % (
-                util_bitcoin.normalize_quantity(message['quantity'], message['divisible']), message['asset']))
+            ingest_logger.info("Adding additional %s quantity for asset %s",
+                util_bitcoin.normalize_quantity(message['quantity'], message['divisible']), message['asset'])
     return True
 
 def inc_fetch_retry(db, asset, max_retry=ASSET_MAX_RETRY, new_status='error', errors=[]):
@@ -161,7 +163,7 @@ def fetch_all_asset_info(db):
     def asset_fetch_complete_hook(urls_data):
         logging.info("Enhanced asset info fetching complete. %s unique URLs fetched. Processing..." % len(urls_data))
         for asset in assets:
-            logging.debug("Looking at asset %s: %s" % (asset, asset['info_url']))
+            logging.debug("Looking at asset %s: %s", asset, asset['info_url'])
             if asset['info_url']:
                 info_url = ('http://' + asset['info_url']) \
                     if not asset['info_url'].startswith('http://') and not asset['info_url'].startswith('https://') else asset['info_url']
@@ -192,7 +194,7 @@ def fetch_all_asset_info(db):
     asset_info_urls_str = ', '.join(asset_info_urls)
     asset_info_urls_str = (asset_info_urls_str[:2000] + ' ...') if len(asset_info_urls_str) > 2000 else asset_info_urls_str #truncate if necessary
     if len(asset_info_urls):
-        logging.info('Fetching enhanced asset info for %i assets: %s' % (len(asset_info_urls), asset_info_urls_str))
+        logging.info('Fetching enhanced asset info for %i assets: %s', len(asset_info_urls), asset_info_urls_str)
         util.stream_fetch(asset_info_urls, asset_fetch_complete_hook,
             fetch_timeout=10, max_fetch_size=4*1024, urls_group_size=20, urls_group_time_spacing=20,
-            per_request_complete_callback=lambda url, data: logging.debug("Asset info URL %s retrieved, result: %s" % (url, data)))
+            per_request_complete_callback=lambda url, data: logging.debug("Asset info URL %s retrieved, result: %s", url, data))
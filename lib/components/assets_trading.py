@@ -13,6 +13,7 @@ import numpy
 import pymongo
 
 from lib import config, util, util_bitcoin
+from lib.components import pricing_graph, prices
 
 D = decimal.Decimal
 
@@ -22,10 +23,35 @@ def get_market_price(price_data, vol_data):
     market_price = numpy.average(price_data, weights=vol_data)
     return market_price
 
+#memoized get_market_price_summary results, keyed by (base_asset, quote_asset, start_dt, end_dt/block, with_last_trades)
+#(indexed by asset pair, so that booking a trade drops just that pair's entries)
+MARKET_PRICE_SUMMARY_CACHE = util.LRUCache(config.MARKET_PRICE_SUMMARY_CACHE_SIZE, group_of=lambda k: (k[0], k[1]))
+
+def invalidate_market_price_summary(asset1=None, asset2=None):
+    """Drops cached market price summaries for the given asset pair (or for all pairs, if no pair is specified).
+    Must be called whenever trades are booked or removed."""
+    if asset1 is None and asset2 is None:
+        return MARKET_PRICE_SUMMARY_CACHE.invalidate()
+    base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
+    return MARKET_PRICE_SUMMARY_CACHE.invalidate_group((base_asset, quote_asset))
+
 def get_market_price_summary(asset1, asset2, with_last_trades=0, start_dt=None, end_dt=None):
     """Gets a synthesized trading "market price" for a specified asset pair (if available), as well as additional info.
     If no price is available, False is returned.
     """
+    base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
+    if not isinstance(with_last_trades, int) or with_last_trades < 0 or with_last_trades > 30:
+        raise Exception("Invalid with_last_trades")
+
+    #an open-ended window ("up to now") is only considered to change when a new block comes in (or new trades are booked)
+    cache_key = (base_asset, quote_asset, start_dt, end_dt or ('block', config.CURRENT_BLOCK_INDEX), with_last_trades)
+    result = MARKET_PRICE_SUMMARY_CACHE.get(cache_key, False)
+    if result is False:
+        result = _get_market_price_summary(base_asset, quote_asset, with_last_trades, start_dt, end_dt)
+        MARKET_PRICE_SUMMARY_CACHE.set(cache_key, result)
+    return copy.deepcopy(result) #callers are free to modify what they get back
+
+def _get_market_price_summary(base_asset, quote_asset, with_last_trades, start_dt, end_dt):
     mongo_db = config.mongo_db
     if not end_dt:
         end_dt = datetime.datetime.utcnow()
@@ -33,13 +59,9 @@ def get_market_price_summary(asset1, asset2, with_last_trades=0, start_dt=None,
         start_dt = end_dt - datetime.timedelta(days=10) #default to 10 days in the past
 
     #look for the last max 6 trades within the past 10 day window
-    base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
     base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
     quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
 
-    if not isinstance(with_last_trades, int) or with_last_trades < 0 or with_last_trades > 30:
-        raise Exception("Invalid with_last_trades")
-
     if not base_asset_info or not quote_asset_info:
         raise Exception("Invalid asset(s)")
 
@@ -131,24 +153,20 @@ def get_xcp_btc_price_info(asset, mps_xcp_btc, xcp_btc_price, btc_xcp_price, wit
         price_summary_in_btc = get_market_price_summary(asset, config.BTC,
             with_last_trades=with_last_trades, start_dt=start_dt, end_dt=end_dt)
 
+        price_in_xcp = price_summary_in_xcp['market_price'] if price_summary_in_xcp else None # None == no trade data
+        price_in_btc = price_summary_in_btc['market_price'] if price_summary_in_btc else None
+        if not end_dt:
+            #no direct market currently: derive a cross rate through the other pairs the asset has recently traded in
+            if price_in_xcp is None: price_in_xcp = pricing_graph.get_cross_rate(asset, config.XCP)
+            if price_in_btc is None: price_in_btc = pricing_graph.get_cross_rate(asset, config.BTC)
+
         #aggregated (averaged) price (expressed as SHP) for the asset on both the SHP and SCH markets
-        if price_summary_in_xcp: # no trade data
-            price_in_xcp = price_summary_in_xcp['market_price']
-            if xcp_btc_price:
-                aggregated_price_in_xcp = float(((D(price_summary_in_xcp['market_price']) + D(xcp_btc_price)) / D(2)))
-            else: aggregated_price_in_xcp = None
-        else:
-            price_in_xcp = None
-            aggregated_price_in_xcp = None
-
-        if price_summary_in_btc: # no trade data
-            price_in_btc = price_summary_in_btc['market_price']
-            if btc_xcp_price:
-                aggregated_price_in_btc = float(((D(price_summary_in_btc['market_price']) + D(btc_xcp_price)) / D(2)))
-            else: aggregated_price_in_btc = None
-        else:
-            aggregated_price_in_btc = None
-            price_in_btc = None
+        if price_in_xcp and xcp_btc_price:
+            aggregated_price_in_xcp = float(((D(price_in_xcp) + D(xcp_btc_price)) / D(2)))
+        else: aggregated_price_in_xcp = None
+        if price_in_btc and btc_xcp_price:
+            aggregated_price_in_btc = float(((D(price_in_btc) + D(btc_xcp_price)) / D(2)))
+        else: aggregated_price_in_btc = None
     else:
         #here we take the normal SHP/SCH pair, and invert it to SCH/SHP, to get SHP's data in terms of a SCH base
         # (this is the only area we do this, as SCH/SHP is NOT standard pair ordering)
@@ -482,14 +500,15 @@ def compile_asset_pair_market_info():
             if price_in_btc:
                 _24h_vol_in_btc = util_bitcoin.round_out(e['vol_base'] * price_in_btc)
 
-            if _24h_vol_in_xcp is None or _24h_vol_in_btc is None:
-                #the base asset didn't have price data against SCH or SHP, or both...try against the quote asset instead
-                price_summary_in_xcp, price_summary_in_btc, price_in_xcp, price_in_btc, aggregated_price_in_xcp, aggregated_price_in_btc = \
-                    get_xcp_btc_price_info(quote_asset, mps_xcp_btc, xcp_btc_price, btc_xcp_price, with_last_trades=0, start_dt=start_dt, end_dt=end_dt)
-                if _24h_vol_in_xcp is None and price_in_xcp:
-                    _24h_vol_in_xcp = util_bitcoin.round_out(e['vol_quote'] * price_in_xcp)
-                if _24h_vol_in_btc is None and price_in_btc:
-                    _24h_vol_in_btc = util_bitcoin.round_out(e['vol_quote'] * price_in_btc)
+            #the base asset didn't have price data against SCH or SHP, or both...derive it from the pricing graph instead
+            if _24h_vol_in_xcp is None:
+                price_in_xcp = pricing_graph.get_cross_rate(base_asset, config.XCP)
+                if price_in_xcp:
+                    _24h_vol_in_xcp = util_bitcoin.round_out(e['vol_base'] * price_in_xcp)
+            if _24h_vol_in_btc is None:
+                price_in_btc = pricing_graph.get_cross_rate(base_asset, config.BTC)
+                if price_in_btc:
+                    _24h_vol_in_btc = util_bitcoin.round_out(e['vol_base'] * price_in_btc)
             pair_data[pair]['24h_vol_in_{}'.format(config.XCP.lower())] = _24h_vol_in_xcp #might still be None
             pair_data[pair]['24h_vol_in_{}'.format(config.BTC.lower())] = _24h_vol_in_btc #might still be None
 
@@ -515,7 +534,8 @@ def compile_asset_pair_market_info():
 
     #remove any old pairs that were not just updated
     mongo_db.asset_pair_market_info.remove({'last_updated': {'$lt': end_dt}})
-    logging.info("Recomposed 24h trade statistics for %i asset pairs: %s" % (len(pair_data), ', '.join(pair_data.keys())))
+    logging.info("Recomposed 24h trade statistics for %i asset pairs", len(pair_data))
+    logging.debug("Recomposed 24h trade statistics for asset pairs: %s", ', '.join(pair_data.keys()))
 
 def compile_asset_market_info():
     """Run through all assets and compose and store market ranking information."""
@@ -560,7 +580,8 @@ def compile_asset_market_info():
             '24h_vol_price_change_in_{}'.format(config.XCP.lower()): None,
             '24h_vol_price_change_in_{}'.format(config.BTC.lower()): None,
     }}, multi=True)
-    logging.info("Block: %s -- Calculated 24h stats for: %s" % (current_block_index, ', '.join(assets)))
+    logging.info("Block: %s -- Calculated 24h stats for %i assets", current_block_index, len(assets))
+    logging.debug("Block: %s -- Calculated 24h stats for: %s", current_block_index, ', '.join(assets))
 
     #######################
     #get a list of all assets with a trade within the last 7d up against SHP and SCH
@@ -577,7 +598,8 @@ def compile_asset_market_info():
             '7d_history_in_{}'.format(config.XCP.lower()): [],
             '7d_history_in_{}'.format(config.BTC.lower()): [],
     }}, multi=True)
-    logging.info("Block: %s -- Calculated 7d stats for: %s" % (current_block_index, ', '.join(assets)))
+    logging.info("Block: %s -- Calculated 7d stats for %i assets", current_block_index, len(assets))
+    logging.debug("Block: %s -- Calculated 7d stats for: %s", current_block_index, ', '.join(assets))
 
     #######################
     #update summary market data for assets traded since last_block_assets_compiled
@@ -588,7 +610,7 @@ def compile_asset_market_info():
     ))
     #update our storage of the latest market info in mongo
     for asset in assets:
-        logging.info("Block: %s -- Updating asset market info for %s ..." % (current_block_index, asset))
+        logging.info("Block: %s -- Updating asset market info for %s ...", current_block_index, asset)
         summary_info = compile_summary_market_info(asset, mps_xcp_btc, xcp_btc_price, btc_xcp_price)
         mongo_db.asset_market_info.update( {'asset': asset}, {"$set": summary_info}, upsert=True)
 
@@ -652,8 +674,10 @@ def compile_asset_market_info():
                             'market_cap': market_cap,
                             'market_cap_as': market_cap_as,
                         })
-                        logging.info("Block %i -- Calculated market cap history point for %s as %s (mID: %s)" % (t['block_index'], asset, market_cap_as, t['message_index']))
+                        logging.info("Block %i -- Calculated market cap history point for %s as %s (mID: %s)", t['block_index'], asset, market_cap_as, t['message_index'])
 
     mongo_db.app_config.update({}, {'$set': {'last_block_assets_compiled': current_block_index}})
+    prices.invalidate() #pick up the newly compiled market info
+    logging.debug("Market price summary cache stats: %s" % MARKET_PRICE_SUMMARY_CACHE.stats())
     return True
 
@@ -140,10 +140,10 @@ def fetch_all_feed_info(db):
     feed_info_urls_str = ', '.join(feed_info_urls)
     feed_info_urls_str = (feed_info_urls_str[:2000] + ' ...') if len(feed_info_urls_str) > 2000 else feed_info_urls_str #truncate if necessary
     if len(feed_info_urls):
-        logging.info('Fetching enhanced feed info for %i feeds: %s' % (len(feed_info_urls), feed_info_urls_str))
+        logging.info('Fetching enhanced feed info for %i feeds: %s', len(feed_info_urls), feed_info_urls_str)
         util.stream_fetch(feed_info_urls, feed_fetch_complete_hook,
             fetch_timeout=10, max_fetch_size=4*1024, urls_group_size=20, urls_group_time_spacing=20,
-            per_request_complete_callback=lambda url, data: logging.debug("Feed at %s retrieved, result: %s" % (url, data)))
+            per_request_complete_callback=lambda url, data: logging.debug("Feed at %s retrieved, result: %s", url, data))
 
 def get_feed_counters(feed_address):
     counters = {}        
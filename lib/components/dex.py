@@ -4,12 +4,22 @@ import decimal
 import base64
 import json
 import time
+import bisect
+import copy
+
+import gevent.lock
 
 from lib import config, util
 
 decimal.setcontext(decimal.Context(prec=8, rounding=decimal.ROUND_HALF_EVEN))
 D = decimal.Decimal
 
+MARKET_ORDERS_DEFAULT_DEPTH = 100 #number of price levels per side returned for the public order book, by default
+MARKET_ORDERS_MAX_DEPTH = 500
+MARKET_ORDERS_BOOK_BATCH_SIZE = 500 #number of orders fetched at a time, per side, when building the public order book
+MARKET_ORDERS_MAX_LIMIT = 1000 #max number of an address' orders returned per call
+MARKET_TRADES_MAX_LIMIT = 1000
+
 def calculate_price(base_quantity, quote_quantity, base_divisibility, quote_divisibility):
     if not base_divisibility:
         base_quantity *= config.UNIT
@@ -129,7 +139,18 @@ def get_xcp_and_btc_pairs(exclude_pairs=[], max_pairs=12, from_time=None):
 
     return all_pairs
 
+#get_users_pairs results, keyed by (addresses, max_pairs, block_index)
+USERS_PAIRS_CACHE = util.LRUCache(config.USERS_PAIRS_CACHE_SIZE)
+
 def get_users_pairs(addresses=[], max_pairs=12):
+    cache_key = (tuple(sorted(set(addresses))), max_pairs, config.CURRENT_BLOCK_INDEX)
+    top_pairs = USERS_PAIRS_CACHE.get(cache_key)
+    if top_pairs is None:
+        top_pairs = _get_users_pairs(addresses, max_pairs)
+        USERS_PAIRS_CACHE.set(cache_key, top_pairs)
+    return copy.deepcopy(top_pairs) #callers are free to modify what they get back
+
+def _get_users_pairs(addresses, max_pairs):
 
     top_pairs = []
     all_assets = []
@@ -168,8 +189,8 @@ def get_users_pairs(addresses=[], max_pairs=12):
     all_assets = list(set(all_assets))
     supplies = get_assets_supply(all_assets)
 
-    for p in range(len(top_pairs)):
-        price, trend, price24h, progression = get_price_movement(top_pairs[p]['base_asset'], top_pairs[p]['quote_asset'], supplies=supplies)
+    price_movements = get_price_movements([(p['base_asset'], p['quote_asset']) for p in top_pairs], supplies=supplies)
+    for p, (price, trend, price24h, progression) in enumerate(price_movements):
         top_pairs[p]['price'] = format(price, ".8f")
         top_pairs[p]['trend'] = trend
         top_pairs[p]['progression'] = format(progression, ".2f")
@@ -178,31 +199,25 @@ def get_users_pairs(addresses=[], max_pairs=12):
     return top_pairs
 
 
-def get_market_orders(asset1, asset2, addresses=[], supplies=None, min_fee_provided=0.95, max_fee_required=0.95):
+def get_market_orders(asset1, asset2, addresses=[], supplies=None, min_fee_provided=0.95, max_fee_required=0.95,
+    depth=MARKET_ORDERS_DEFAULT_DEPTH, limit=MARKET_ORDERS_MAX_LIMIT, before_tx_index=None):
+    """
+    Without addresses, returns the public order book for the pair: open orders aggregated into price levels, with up
+    to depth levels per side (best prices first, BUY side then SELL side).
+    With addresses, returns up to limit of the open orders placed by those addresses (newest first). To page
+    through them, pass the tx_index of the last order returned as before_tx_index.
+    """
+    if depth > MARKET_ORDERS_MAX_DEPTH or depth <= 0:
+        raise Exception("Invalid depth (max %i)" % MARKET_ORDERS_MAX_DEPTH)
+    if limit > MARKET_ORDERS_MAX_LIMIT or limit <= 0:
+        raise Exception("Invalid limit (max %i)" % MARKET_ORDERS_MAX_LIMIT)
 
     base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
     if not supplies:
         supplies = get_assets_supply([asset1, asset2])
-    market_orders = []
 
-    sql = '''SELECT orders.*, blocks.block_time FROM orders INNER JOIN blocks ON orders.block_index=blocks.block_index
-             WHERE  status = ? '''
-    bindings = ['open']
-
-    if len(addresses) > 0:
-        sql += '''AND source IN ({}) '''.format(','.join(['?' for e in range(0,len(addresses))]))
-        bindings += addresses
-
-    sql += '''AND give_remaining > 0
-              AND give_asset IN (?, ?)
-              AND get_asset IN (?, ?)
-              ORDER BY tx_index DESC'''
-
-    bindings +=  [asset1, asset2, asset1, asset2]
-
-    orders = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
-
-    for order in orders:
+    def make_market_order(order):
+        """Returns the order as we present it, or None if it is excluded by its SCH fee"""
         user_order = {}
 
         exclude = False
@@ -224,44 +239,117 @@ def get_market_orders(asset1, asset2, addresses=[], supplies=None, min_fee_provi
 
             exclude = fee_required > max_fee_required
 
+        if exclude:
+            return None
 
-        if not exclude:
-            if order['give_asset'] == base_asset:
-                price = calculate_price(order['give_quantity'], order['get_quantity'], supplies[order['give_asset']][1], supplies[order['get_asset']][1])
-                user_order['type'] = 'SELL'
-                user_order['amount'] = order['give_remaining']
-                user_order['total'] = int(order['give_remaining'] * price)
-            else:
-                price = calculate_price(order['get_quantity'], order['give_quantity'], supplies[order['get_asset']][1], supplies[order['give_asset']][1])
-                user_order['type'] = 'BUY'
-                user_order['total'] = order['give_remaining']
-                user_order['amount'] = int(order['give_remaining'] / price)
-
-            user_order['price'] = format(price, '.8f')
-
-            if len(addresses) == 0 and len(market_orders) > 0:
-                previous_order = market_orders[-1]
-                if previous_order['type'] == user_order['type'] and previous_order['price'] == user_order['price']:
-                    market_orders[-1]['amount'] += user_order['amount']
-                    market_orders[-1]['total'] += user_order['total']
-                    exclude = True
-
-            if len(addresses) > 0:
-                completed = format(((D(order['give_quantity']) - D(order['give_remaining'])) / D(order['give_quantity'])) * D(100), '.2f')
-                user_order['completion'] = "{}%".format(completed)
-                user_order['tx_index'] = order['tx_index']
-                user_order['tx_hash'] = order['tx_hash']
-                user_order['source'] = order['source']
-                user_order['block_index'] = order['block_index']
-                user_order['block_time'] = order['block_time']
-
-        if not exclude:
-            market_orders.append(user_order)
-
-    return market_orders
+        if order['give_asset'] == base_asset:
+            price = calculate_price(order['give_quantity'], order['get_quantity'], supplies[order['give_asset']][1], supplies[order['get_asset']][1])
+            user_order['type'] = 'SELL'
+            user_order['amount'] = order['give_remaining']
+            user_order['total'] = int(order['give_remaining'] * price)
+        else:
+            price = calculate_price(order['get_quantity'], order['give_quantity'], supplies[order['get_asset']][1], supplies[order['give_asset']][1])
+            user_order['type'] = 'BUY'
+            user_order['total'] = order['give_remaining']
+            user_order['amount'] = int(order['give_remaining'] / price)
+
+        user_order['price'] = format(price, '.8f')
+
+        if len(addresses) > 0:
+            completed = format(((D(order['give_quantity']) - D(order['give_remaining'])) / D(order['give_quantity'])) * D(100), '.2f')
+            user_order['completion'] = "{}%".format(completed)
+            user_order['tx_index'] = order['tx_index']
+            user_order['tx_hash'] = order['tx_hash']
+            user_order['source'] = order['source']
+            user_order['block_index'] = order['block_index']
+            user_order['block_time'] = order['block_time']
+        return user_order
 
+    sql = '''SELECT orders.*, blocks.block_time FROM orders INNER JOIN blocks ON orders.block_index=blocks.block_index
+             WHERE  status = ?
+             AND give_remaining > 0 '''
 
-def get_market_trades(asset1, asset2, addresses=[], limit=100, supplies=None):
+    if len(addresses) > 0:
+        #fetch (newest first) until limit orders have made it past the fee filter, or there are no more
+        sql += '''AND source IN ({})
+                  AND give_asset IN (?, ?)
+                  AND get_asset IN (?, ?) '''.format(','.join(['?' for e in range(0,len(addresses))]))
+        bindings = ['open'] + addresses + [asset1, asset2, asset1, asset2]
+        market_orders = []
+        while len(market_orders) < limit:
+            page_sql = sql + ('''AND tx_index < ? ''' if before_tx_index is not None else '')
+            page_sql += '''ORDER BY tx_index DESC
+                           LIMIT ?'''
+            page_bindings = bindings + ([before_tx_index] if before_tx_index is not None else []) + [limit]
+            orders = util.call_jsonrpc_api('sql', {'query': page_sql, 'bindings': page_bindings})['result']
+            market_orders += [o for o in [make_market_order(order) for order in orders] if o is not None]
+            if len(orders) < limit:
+                break
+            before_tx_index = orders[-1]['tx_index']
+        return market_orders[:limit]
+
+    #public order book: fetch each side best price first, a batch at a time, until it has depth complete price levels
+    # (after the fee filter), i.e. until an order past the last of them is seen, or there are no more orders
+    # batches are fetched with a keyset cursor on (price, tx_index), the price being what the base asset is sold (or
+    # bought) for, so that each batch picks up right where the last one left off
+    sides = (
+        #(give asset, get asset, price expression, ordering (best first), comparison for "after the cursor")
+        (base_asset, quote_asset, 'CAST(get_quantity AS REAL) / give_quantity', 'ASC', '>'),
+        (quote_asset, base_asset, 'CAST(give_quantity AS REAL) / get_quantity', 'DESC', '<'),
+    )
+    levels = {}
+    for give_asset, get_asset, price_expr, price_ordering, price_after in sides:
+        side_sql = '''SELECT orders.*, blocks.block_time, {price} AS book_price
+                      FROM orders INNER JOIN blocks ON orders.block_index=blocks.block_index
+                      WHERE status = ?
+                      AND give_remaining > 0
+                      AND give_quantity > 0
+                      AND get_quantity > 0
+                      AND give_asset = ?
+                      AND get_asset = ? '''.format(price=price_expr)
+        cursor_sql = '''AND ({price} {after} ? OR ({price} = ? AND tx_index > ?)) '''.format(price=price_expr, after=price_after)
+        order_by = '''ORDER BY book_price {}, tx_index ASC
+                      LIMIT ?'''.format(price_ordering)
+        num_side_levels = 0
+        cursor = None #(book_price, tx_index) of the last order fetched
+        while num_side_levels <= depth:
+            if cursor is None:
+                orders = util.call_jsonrpc_api('sql', {'query': side_sql + order_by,
+                    'bindings': ['open', give_asset, get_asset, MARKET_ORDERS_BOOK_BATCH_SIZE]})['result']
+            else:
+                orders = util.call_jsonrpc_api('sql', {'query': side_sql + cursor_sql + order_by,
+                    'bindings': ['open', give_asset, get_asset, cursor[0], cursor[0], cursor[1], MARKET_ORDERS_BOOK_BATCH_SIZE]})['result']
+            for order in orders:
+                order = make_market_order(order)
+                if order is None:
+                    continue
+                #aggregate into price levels
+                key = (order['type'], order['price'])
+                if key in levels:
+                    levels[key]['amount'] += order['amount']
+                    levels[key]['total'] += order['total']
+                else:
+                    levels[key] = order
+                    num_side_levels += 1
+            if len(orders) < MARKET_ORDERS_BOOK_BATCH_SIZE:
+                break
+            cursor = (orders[-1]['book_price'], orders[-1]['tx_index'])
+    #(each side may have gone past depth levels; those are cut off here)
+    buy_levels = sorted([l for l in levels.itervalues() if l['type'] == 'BUY'], key=lambda l: D(l['price']), reverse=True)
+    sell_levels = sorted([l for l in levels.itervalues() if l['type'] == 'SELL'], key=lambda l: D(l['price']))
+    return buy_levels[:depth] + sell_levels[:depth]
+
+
+def get_market_trades(asset1, asset2, addresses=[], limit=100, supplies=None, before_block_index=None, before_tx_index=None):
+    """
+    Returns the trades of the pair (or those of the specified addresses in the pair), newest first, for up to limit
+    order matches. To page through them, pass the block_index and tx_index of the last trade returned as
+    before_block_index and before_tx_index. The order matches of a transaction are never split across pages.
+    """
+    if limit > MARKET_TRADES_MAX_LIMIT or limit <= 0:
+        raise Exception("Invalid limit (max %i)" % MARKET_TRADES_MAX_LIMIT)
+    if before_tx_index is not None and before_block_index is None:
+        raise Exception("before_tx_index must be passed along with before_block_index")
 
     base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
     if not supplies:
@@ -278,12 +366,31 @@ def get_market_trades(asset1, asset2, addresses=[], limit=100, supplies=None):
     sql = '''SELECT order_matches.*, blocks.block_time FROM order_matches INNER JOIN blocks ON order_matches.block_index=blocks.block_index
              WHERE status != ? {}
                 AND forward_asset IN (?, ?)
-                AND backward_asset IN (?, ?)
-             ORDER BY block_index DESC'''.format(sources)
-
+                AND backward_asset IN (?, ?) '''.format(sources)
     bindings +=  [asset1, asset2, asset1, asset2]
-
-    order_matches = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
+    order_by = '''ORDER BY order_matches.block_index DESC, tx1_index DESC, tx0_index DESC '''
+
+    cursor_sql = ''
+    cursor_bindings = []
+    if before_block_index is not None and before_tx_index is not None:
+        cursor_sql = '''AND (order_matches.block_index < ? OR (order_matches.block_index = ? AND tx1_index < ?)) '''
+        cursor_bindings = [before_block_index, before_block_index, before_tx_index]
+    elif before_block_index is not None:
+        cursor_sql = '''AND order_matches.block_index < ? '''
+        cursor_bindings = [before_block_index]
+
+    #get one more than asked for, to tell whether the page would end in the middle of a transaction's order matches
+    order_matches = util.call_jsonrpc_api('sql', {
+        'query': sql + cursor_sql + order_by + 'LIMIT ?',
+        'bindings': bindings + cursor_bindings + [limit + 1]})['result']
+    if len(order_matches) > limit:
+        next_order_match = order_matches[limit]
+        order_matches = order_matches[:limit]
+        if next_order_match['tx1_index'] == order_matches[-1]['tx1_index']:
+            #get the rest of the order matches of the last transaction on the page
+            order_matches += util.call_jsonrpc_api('sql', {
+                'query': sql + '''AND tx1_index = ? AND tx0_index < ? ''' + order_by,
+                'bindings': bindings + [order_matches[-1]['tx1_index'], order_matches[-1]['tx0_index']]})['result']
 
     for order_match in order_matches:
 
@@ -293,6 +400,7 @@ def get_market_trades(asset1, asset2, addresses=[], limit=100, supplies=None):
             trade['source'] = order_match['tx0_address']
             trade['countersource'] = order_match['tx1_address']
             trade['block_index'] = order_match['block_index']
+            trade['tx_index'] = order_match['tx1_index']
             trade['block_time'] = order_match['block_time']
             trade['status'] = order_match['status']
             if order_match['forward_asset'] == base_asset:
@@ -313,6 +421,7 @@ def get_market_trades(asset1, asset2, addresses=[], limit=100, supplies=None):
             trade['source'] = order_match['tx1_address']
             trade['countersource'] = order_match['tx0_address']
             trade['block_index'] = order_match['block_index']
+            trade['tx_index'] = order_match['tx1_index']
             trade['block_time'] = order_match['block_time']
             trade['status'] = order_match['status']
             if order_match['backward_asset'] == base_asset:
@@ -330,30 +439,33 @@ def get_market_trades(asset1, asset2, addresses=[], limit=100, supplies=None):
     return market_trades
 
 
-def get_assets_supply(assets=[]):
-
-    supplies = {}
-
-    if 'SHP' in assets:
-        supplies['SHP'] = (util.call_jsonrpc_api('get_xcp_supply', [])['result'], True)
-        assets.remove('SHP')
+#asset -> (supply, divisible), as of block_index. filled lazily out of tracked_assets, and reset every block
+_supply_index = {'block_index': None, 'supplies': {}}
 
-    if 'SCH' in assets:
-        supplies['SCH'] = (0, True)
-        assets.remove('SCH')
-
-    if len(assets) > 0:
-        sql = '''SELECT asset, SUM(quantity) AS supply, divisible FROM issuances
-                 WHERE asset IN ({})
-                 AND status = ?
-                 GROUP BY asset
-                 ORDER BY asset'''.format(','.join(['?' for e in range(0,len(assets))]))
-        bindings = assets + ['valid']
+def get_assets_supply(assets=[]):
 
-        issuances = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
-        for issuance in issuances:
-            supplies[issuance['asset']] = (issuance['supply'], issuance['divisible'])
+    if _supply_index['block_index'] != config.CURRENT_BLOCK_INDEX:
+        _supply_index['supplies'] = {}
+        _supply_index['block_index'] = config.CURRENT_BLOCK_INDEX
+    index = _supply_index['supplies']
+
+    missing = [asset for asset in set(assets) if asset not in index]
+    if 'SHP' in missing:
+        index['SHP'] = (util.call_jsonrpc_api('get_xcp_supply', [])['result'], True)
+        missing.remove('SHP')
+    if 'SCH' in missing:
+        index['SCH'] = (0, True)
+        missing.remove('SCH')
+    if len(missing) > 0:
+        tracked_assets = config.mongo_db.tracked_assets.find({'asset': {'$in': missing}},
+            {'_id': 0, 'asset': 1, 'total_issued': 1, 'divisible': 1})
+        for tracked_asset in tracked_assets:
+            index[tracked_asset['asset']] = (tracked_asset['total_issued'], tracked_asset['divisible'])
 
+    supplies = {}
+    for asset in assets:
+        if asset in index:
+            supplies[asset] = index[asset]
     return supplies
 
 
@@ -388,9 +500,9 @@ def get_pair_price(base_asset, quote_asset, max_block_time=None, supplies=None):
     trend = 0
     if len(order_matches) == 2:
         if order_matches[1]['forward_asset'] == base_asset:
-            before_last_price = calculate_price(order_matches[0]['forward_quantity'], order_matches[0]['backward_quantity'], supplies[order_matches[0]['forward_asset']][1], supplies[order_matches[0]['backward_asset']][1])
+            before_last_price = calculate_price(order_matches[1]['forward_quantity'], order_matches[1]['backward_quantity'], supplies[order_matches[1]['forward_asset']][1], supplies[order_matches[1]['backward_asset']][1])
         else:
-            before_last_price = calculate_price(order_matches[0]['backward_quantity'], order_matches[0]['forward_quantity'], supplies[order_matches[0]['backward_asset']][1], supplies[order_matches[0]['forward_asset']][1])
+            before_last_price = calculate_price(order_matches[1]['backward_quantity'], order_matches[1]['forward_quantity'], supplies[order_matches[1]['backward_asset']][1], supplies[order_matches[1]['forward_asset']][1])
         if last_price < before_last_price:
             trend = -1
         elif last_price > before_last_price:
@@ -398,20 +510,159 @@ def get_pair_price(base_asset, quote_asset, max_block_time=None, supplies=None):
 
     return D(last_price), trend
 
-def get_price_movement(base_asset, quote_asset, supplies=None):
-
-    yesterday = int(time.time() - (24*60*60))
-    if not supplies:
-        supplies = get_assets_supply([base_asset, quote_asset])
+#recent order match prices per pair, kept up to date by the blockfeed (see track_order_match). for each pair, holds
+# every order match of the last 24h, plus the (up to) 2 latest ones before that, so that both the current price and
+# the price 24h ago are available without querying counterpartyd
+PAIR_PRICES_MAX_LENGTH = 1000 #max order matches held per pair
+PAIR_PRICES_MAX_PAIRS_PER_QUERY = 100
+#(asset1, asset2) (sorted) -> {'entries': [(block_time, tx_index, order_match_id, asset1 qty, asset2 qty), ...] (ascending),
+# 'ids': set of order_match_id, 'loaded': bool, 'complete': False if matches within the last 24h had to be dropped}
+_pair_prices = {}
+
+def reset_pair_prices():
+    """Drops all tracked pair prices (e.g. after a reorg), to be reloaded from counterpartyd on next use, along with
+    the cached results derived from them"""
+    _pair_prices.clear()
+    USERS_PAIRS_CACHE.invalidate()
+
+def _add_pair_price(pair_prices, order_match, block_time, supplies):
+    order_match_id = order_match['tx0_hash'] + order_match['tx1_hash']
+    if order_match_id in pair_prices['ids']:
+        return
+    #quantities are stored as calculate_price takes them for divisible assets, so prices can be had either way round
+    quantities = {}
+    for asset, quantity in ((order_match['forward_asset'], order_match['forward_quantity']),
+                            (order_match['backward_asset'], order_match['backward_quantity'])):
+        quantities[asset] = quantity if supplies[asset][1] else quantity * config.UNIT
+    asset1, asset2 = sorted(quantities.keys())
+    tx_index = max(order_match['tx0_index'], order_match['tx1_index'])
+    bisect.insort(pair_prices['entries'], (block_time, tx_index, order_match_id, quantities[asset1], quantities[asset2]))
+    pair_prices['ids'].add(order_match_id)
+    if len(pair_prices['entries']) > PAIR_PRICES_MAX_LENGTH:
+        dropped = pair_prices['entries'].pop(0)
+        pair_prices['ids'].discard(dropped[2])
+        pair_prices['complete'] = False
+
+def _trim_pair_prices(pair_prices, max_block_time):
+    #keep the 2 latest order matches at or before max_block_time (for the price at that time, and its trend)
+    num_before = bisect.bisect_right(pair_prices['entries'], (max_block_time, float('inf')))
+    if num_before > 2:
+        for dropped in pair_prices['entries'][:num_before - 2]:
+            pair_prices['ids'].discard(dropped[2])
+        del pair_prices['entries'][:num_before - 2]
+
+def track_order_match(order_match, block_time):
+    """Records a new order match for the price movement of its pair (if the pair is being tracked)"""
+    pair_prices = _pair_prices.get(tuple(sorted([order_match['forward_asset'], order_match['backward_asset']])), None)
+    if pair_prices is None:
+        return #loaded from counterpartyd (with this order match) on first use
+    supplies = get_assets_supply([order_match['forward_asset'], order_match['backward_asset']])
+    _add_pair_price(pair_prices, order_match, block_time, supplies)
+
+def _query_pairs_order_matches(keys, block_time_op, block_time, limit):
+    """Gets the latest order matches (up to limit per pair) of each of the specified pairs, from before or after the
+    specified block time, in one query"""
+    pair_sql = '''SELECT * FROM (
+                    SELECT *, MAX(tx0_index, tx1_index) AS tx_index, blocks.block_time
+                    FROM order_matches INNER JOIN blocks ON order_matches.block_index = blocks.block_index
+                    WHERE
+                       forward_asset IN (?, ?) AND
+                       backward_asset IN (?, ?) AND
+                       block_time {} ?
+                    ORDER BY tx_index DESC
+                    LIMIT ?)'''.format(block_time_op)
+    order_matches_by_key = dict([(key, []) for key in keys])
+    for i in xrange(0, len(keys), PAIR_PRICES_MAX_PAIRS_PER_QUERY): #keep within sqlite's compound select and binding limits
+        bindings = []
+        for asset1, asset2 in keys[i:i + PAIR_PRICES_MAX_PAIRS_PER_QUERY]:
+            bindings += [asset1, asset2, asset1, asset2, block_time, limit]
+        order_matches = util.call_jsonrpc_api('sql', {'query': ' UNION ALL '.join([pair_sql] * (len(bindings) / 6)), 'bindings': bindings})['result']
+        for order_match in order_matches:
+            order_matches_by_key[tuple(sorted([order_match['forward_asset'], order_match['backward_asset']]))].append(order_match)
+    return order_matches_by_key
+
+def _get_pairs_prices(pairs, supplies, yesterday):
+    """Returns the tracked prices of each of the specified (base_asset, quote_asset) pairs, keyed by (asset1, asset2)
+    (sorted). Pairs not tracked yet are loaded from counterpartyd, with 2 queries in all"""
+    pairs_prices = {}
+    keys_to_load = []
+    for base_asset, quote_asset in pairs:
+        key = tuple(sorted([base_asset, quote_asset]))
+        if key in pairs_prices:
+            continue
+        if key in _pair_prices:
+            if _pair_prices[key]['loaded']:
+                _trim_pair_prices(_pair_prices[key], yesterday)
+        else:
+            #register first, so that order matches that come in while loading are not missed
+            _pair_prices[key] = {'entries': [], 'ids': set(), 'loaded': False, 'complete': True}
+            keys_to_load.append(key)
+        pairs_prices[key] = _pair_prices[key]
+    if not keys_to_load:
+        return pairs_prices
 
-    price, trend = get_pair_price(base_asset, quote_asset, supplies=supplies)
-    price24h, trend24h = get_pair_price(base_asset, quote_asset, max_block_time=yesterday, supplies=supplies)
     try:
-        progression = (price - price24h) / (price24h / D(100))
+        recent_matches = _query_pairs_order_matches(keys_to_load, '>', yesterday, PAIR_PRICES_MAX_LENGTH + 1)
+        older_matches = _query_pairs_order_matches(keys_to_load, '<=', yesterday, 2)
     except:
-        progression = D(0)
+        for key in keys_to_load:
+            del _pair_prices[key]
+        raise
+    for key in keys_to_load:
+        pair_prices = _pair_prices[key]
+        if len(recent_matches[key]) > PAIR_PRICES_MAX_LENGTH:
+            pair_prices['complete'] = False
+        for order_match in recent_matches[key][:PAIR_PRICES_MAX_LENGTH] + (older_matches[key] if pair_prices['complete'] else []):
+            _add_pair_price(pair_prices, order_match, order_match['block_time'], supplies)
+        pair_prices['loaded'] = True
+    return pairs_prices
+
+def _get_pair_price_from_entries(entries, base_asset, quote_asset):
+    """Same as get_pair_price, from the specified pair price entries (the last of which is the latest order match)"""
+    base_qty_pos, quote_qty_pos = (3, 4) if base_asset < quote_asset else (4, 3)
+    if len(entries) == 0:
+        return D(0.0), 0
+    last_price = calculate_price(entries[-1][base_qty_pos], entries[-1][quote_qty_pos], True, True)
+    trend = 0
+    if len(entries) >= 2:
+        before_last_price = calculate_price(entries[-2][base_qty_pos], entries[-2][quote_qty_pos], True, True)
+        if last_price < before_last_price:
+            trend = -1
+        elif last_price > before_last_price:
+            trend = 1
+    return D(last_price), trend
 
-    return price, trend, price24h, progression
+def get_price_movements(pairs, supplies=None):
+    """Batch version of get_price_movement, for a list of (base_asset, quote_asset) pairs. Returns a list of
+    (price, trend, price24h, progression) tuples, in the same order"""
+    yesterday = int(time.time() - (24*60*60))
+    if not supplies:
+        supplies = get_assets_supply(list(set([asset for pair in pairs for asset in pair])))
+
+    pairs_prices = _get_pairs_prices(pairs, supplies, yesterday)
+    movements = []
+    for base_asset, quote_asset in pairs:
+        pair_prices = pairs_prices[tuple(sorted([base_asset, quote_asset]))]
+        if pair_prices['loaded']:
+            entries = pair_prices['entries']
+            price, trend = _get_pair_price_from_entries(entries, base_asset, quote_asset)
+            if pair_prices['complete']:
+                price24h, trend24h = _get_pair_price_from_entries(
+                    entries[:bisect.bisect_right(entries, (yesterday, float('inf')))], base_asset, quote_asset)
+            else: #too many order matches in the last 24h to hold them all
+                price24h, trend24h = get_pair_price(base_asset, quote_asset, max_block_time=yesterday, supplies=supplies)
+        else: #still being loaded by another request
+            price, trend = get_pair_price(base_asset, quote_asset, supplies=supplies)
+            price24h, trend24h = get_pair_price(base_asset, quote_asset, max_block_time=yesterday, supplies=supplies)
+        try:
+            progression = (price - price24h) / (price24h / D(100))
+        except:
+            progression = D(0)
+        movements.append((price, trend, price24h, progression))
+    return movements
+
+def get_price_movement(base_asset, quote_asset, supplies=None):
+    return get_price_movements([(base_asset, quote_asset)], supplies=supplies)[0]
 
 def get_markets_list(mongo_db=None):
 
@@ -438,8 +689,8 @@ def get_markets_list(mongo_db=None):
             if 'info_data' in info and 'valid_image' in info['info_data'] and info['info_data']['valid_image']:
                 asset_with_image[info['asset']] = True
 
-    for pair in pairs:
-        price, trend, price24h, progression = get_price_movement(pair['base_asset'], pair['quote_asset'], supplies=supplies)
+    price_movements = get_price_movements([(pair['base_asset'], pair['quote_asset']) for pair in pairs], supplies=supplies)
+    for pair, (price, trend, price24h, progression) in zip(pairs, price_movements):
         market = {}
         market['base_asset'] = pair['base_asset']
         market['quote_asset'] = pair['quote_asset']
@@ -462,6 +713,39 @@ def get_markets_list(mongo_db=None):
 
     return markets
 
+#the markets list, as last compiled (once per block, see events.compile_markets_list), as a dict with block_index,
+# markets and json. only ever replaced as a whole, never modified
+_markets_list_snapshot = None
+_markets_list_compile_lock = gevent.lock.Semaphore() #so that the list is only ever being compiled once at a time
+
+def compile_markets_list(mongo_db):
+    """Rebuilds the markets list for the current block, returning the new snapshot"""
+    global _markets_list_snapshot
+    with _markets_list_compile_lock:
+        block_index = config.CURRENT_BLOCK_INDEX #store now as it may change while we are compiling
+        markets = get_markets_list(mongo_db)
+        _markets_list_snapshot = {
+            'block_index': block_index,
+            'markets': markets,
+            'json': util.PreSerializedJSON(json.dumps(markets, separators=(',', ':'))),
+        }
+        return _markets_list_snapshot
+
+def get_markets_list_snapshot(mongo_db):
+    """Returns the serialized markets list, as last compiled. It is kept up to date by events.compile_markets_list,
+    and compiled here only if it never was (with any concurrent callers waiting on that one compile)"""
+    snapshot = _markets_list_snapshot
+    if snapshot is None:
+        with _markets_list_compile_lock:
+            snapshot = _markets_list_snapshot #(compiled by whoever held the lock before us, if anyone)
+        if snapshot is None:
+            snapshot = compile_markets_list(mongo_db)
+    return snapshot['json']
+
+def get_markets_list_snapshot_block_index():
+    snapshot = _markets_list_snapshot
+    return snapshot['block_index'] if snapshot else None
+
 
 def get_market_details(asset1, asset2, min_fee_provided=0.95, max_fee_required=0.95, mongo_db=None):
 
@@ -0,0 +1,219 @@
+"""
+Balance and portfolio valuation functionality for sets of addresses
+"""
+import datetime
+import calendar
+
+import numpy
+import pymongo
+
+from lib import config
+from lib.components import assets_trading, prices
+
+PORTFOLIO_HISTORY_INTERVALS = {'hour': 60 * 60, 'day': 24 * 60 * 60}
+PORTFOLIO_HISTORY_MAX_POINTS = 2000
+PORTFOLIO_HISTORY_PRICE_LOOKBACK = 10 * 24 * 60 * 60 #how far before start_ts to look for a trade to carry a price forward from
+
+def get_normalized_balances(addresses):
+    """
+    Returns the asset balances of the specified addresses (as counterpartyd's get_balances does), with a
+    normalized_quantity field. It also will include any owned assets for an address, even if their balance is zero.
+    Served from the current_balances collection that the blockfeed maintains.
+    NOTE: Does not retrieve SCH balance. Use get_address_info for that.
+    """
+    mongo_db = config.mongo_db
+    if not isinstance(addresses, list):
+        raise Exception("addresses must be a list of addresses, even if it just contains one address")
+    if not len(addresses):
+        raise Exception("Invalid address list supplied")
+
+    isowner = {}
+    owned_assets = mongo_db.tracked_assets.find( { 'owner': { '$in': addresses } }, { '_history': 0, '_id': 0 } )
+    for o in owned_assets:
+      isowner[o['owner'] + o['asset']] = o
+
+    data = []
+    mappings = {}
+    balances = mongo_db.current_balances.find( { 'address': { '$in': addresses } },
+        { '_id': 0, 'address': 1, 'asset': 1, 'quantity': 1, 'normalized_quantity': 1 } )
+    for d in balances:
+        if not d['quantity'] and ((d['address'] + d['asset']) not in isowner):
+            continue #don't include balances with a zero asset value
+        d['owner'] = (d['address'] + d['asset']) in isowner
+        mappings[d['address'] + d['asset']] = d
+        data.append(d)
+
+    #include any owned assets for each address, even if their balance is zero
+    for key in isowner:
+        if key not in mappings:
+            o = isowner[key]
+            data.append({
+                'address': o['owner'],
+                'asset': o['asset'],
+                'quantity': 0,
+                'normalized_quantity': 0,
+                'owner': True,
+            })
+
+    return data
+
+def get_price_matrix(assets):
+    """Returns a (len(assets), 2) NumPy array holding the current value of 1 unit of each asset in SHP (column 0) and
+    SCH (column 1), with NaN where no price is available.
+    NOTE: prices are expressed in the trades' unit_price convention, i.e. as units of the quote asset (SHP or SCH) per
+    unit of the asset. SHP and SCH themselves are valued against each other via the SHP/SCH market price.
+    """
+    fields = ['price_in_{}'.format(config.XCP.lower()), 'price_in_{}'.format(config.BTC.lower())]
+    vectors = prices.get_price_vectors(assets, fields)
+    matrix = numpy.column_stack([vectors[f] for f in fields]) if len(assets) else numpy.empty((0, 2))
+
+    mps_xcp_btc, xcp_btc_price, btc_xcp_price = assets_trading.get_price_primatives() #xcp_btc_price == SCH per SHP
+    for i, asset in enumerate(assets):
+        if asset == config.XCP:
+            matrix[i] = [1.0, xcp_btc_price if xcp_btc_price else numpy.nan]
+        elif asset == config.BTC:
+            matrix[i] = [btc_xcp_price if btc_xcp_price else numpy.nan, 1.0]
+    return matrix
+
+def get_portfolio_value(addresses):
+    """Returns the holdings of the specified addresses (summed per asset), each valued in SHP and SCH, along with the
+    total portfolio value. Assets with no current market price are listed with a value of None and are not counted
+    towards the total.
+    """
+    balances = get_normalized_balances(addresses)
+    quantities_by_asset = {}
+    for b in balances:
+        quantities_by_asset[b['asset']] = quantities_by_asset.get(b['asset'], 0) + b['normalized_quantity']
+    assets = sorted(quantities_by_asset.keys())
+
+    quantities = numpy.array([quantities_by_asset[asset] for asset in assets], dtype=numpy.float64)
+    price_matrix = get_price_matrix(assets)
+    values = quantities[:, numpy.newaxis] * price_matrix #(num_assets, 2)
+    priced = ~numpy.isnan(values)
+    totals = numpy.where(priced, values, 0.0).sum(axis=0) if len(assets) else numpy.zeros(2)
+
+    holdings = []
+    for i, asset in enumerate(assets):
+        holdings.append({
+            'asset': asset,
+            'quantity': quantities_by_asset[asset],
+            'value_in_{}'.format(config.XCP.lower()): float(values[i, 0]) if priced[i, 0] else None,
+            'value_in_{}'.format(config.BTC.lower()): float(values[i, 1]) if priced[i, 1] else None,
+        })
+    return {
+        'block_index': config.CURRENT_BLOCK_INDEX,
+        'holdings': holdings,
+        'total_value_in_{}'.format(config.XCP.lower()): float(totals[0]),
+        'total_value_in_{}'.format(config.BTC.lower()): float(totals[1]),
+    }
+
+def _to_ts(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+def _forward_fill(event_times, event_values, grid, initial_value=numpy.nan):
+    """Samples a step series (event_values, taking effect at event_times, ascending) at each grid time, carrying the
+    last value at or before each grid time forward (or initial_value, if there is none yet)"""
+    if not len(event_times):
+        filled = numpy.empty(len(grid)); filled.fill(initial_value)
+        return filled
+    positions = numpy.searchsorted(numpy.asarray(event_times, dtype=numpy.float64), grid, side='right') - 1
+    values = numpy.asarray(event_values, dtype=numpy.float64)[numpy.maximum(positions, 0)]
+    return numpy.where(positions >= 0, values, initial_value)
+
+def get_portfolio_history(addresses, start_ts=None, end_ts=None, interval='day'):
+    """Returns the total value of the holdings of the specified addresses in SHP and SCH at every interval ('hour' or
+    'day') within the specified date range.
+    Balances (from balance_changes) and prices (the last trade price of each asset against SHP and SCH, from trades)
+    are both carried forward to each interval point, and the values at each point are the dot product of the two.
+    @return: A dict with value_in_shp and value_in_sch lists, each holding [interval time (epoch in MS), value] pairs
+    """
+    mongo_db = config.mongo_db
+    if not isinstance(addresses, list) or not len(addresses):
+        raise Exception("addresses must be a non-empty list of addresses, even if it just contains one address")
+    if interval not in PORTFOLIO_HISTORY_INTERVALS:
+        raise Exception("Invalid interval (must be one of: %s)" % ', '.join(PORTFOLIO_HISTORY_INTERVALS.keys()))
+    step = PORTFOLIO_HISTORY_INTERVALS[interval]
+    now_ts = _to_ts(datetime.datetime.utcnow())
+    if not end_ts: #default to current datetime
+        end_ts = now_ts
+    if not start_ts: #default to 30 days before the end date
+        start_ts = end_ts - (30 * 24 * 60 * 60)
+    start_ts = start_ts - (start_ts % step) #align to the interval
+    if start_ts > end_ts or (end_ts - start_ts) / step >= PORTFOLIO_HISTORY_MAX_POINTS:
+        raise Exception("Invalid date range (max %i intervals)" % PORTFOLIO_HISTORY_MAX_POINTS)
+    grid = numpy.arange(start_ts, end_ts + 1, step, dtype=numpy.float64)
+    start_dt = datetime.datetime.utcfromtimestamp(start_ts)
+    end_dt = datetime.datetime.utcfromtimestamp(end_ts)
+
+    #BALANCES: the balance of each (address, asset) as of the start of the range, then every change within it
+    series = {} #(address, asset) -> {'initial': balance, 'times': [...], 'balances': [...]}
+    initial_balances = mongo_db.balance_changes.aggregate([
+        {"$match": {"address": {"$in": addresses}, "block_time": {"$lt": start_dt}}},
+        {"$sort": {"block_time": pymongo.ASCENDING}},
+        {"$group": {
+            "_id": {"address": "$address", "asset": "$asset"},
+            "balance": {"$last": "$new_balance_normalized"},
+        }},
+    ])
+    for e in ([] if not initial_balances['ok'] else initial_balances['result']):
+        series[(e['_id']['address'], e['_id']['asset'])] = {'initial': e['balance'], 'times': [], 'balances': []}
+    balance_changes = mongo_db.balance_changes.find(
+        {'address': {'$in': addresses}, 'block_time': {'$gte': start_dt, '$lte': end_dt}},
+        {'_id': 0, 'address': 1, 'asset': 1, 'block_time': 1, 'new_balance_normalized': 1}
+    ).sort('block_time', pymongo.ASCENDING)
+    for c in balance_changes:
+        e = series.setdefault((c['address'], c['asset']), {'initial': 0, 'times': [], 'balances': []})
+        e['times'].append(_to_ts(c['block_time']))
+        e['balances'].append(c['new_balance_normalized'])
+
+    assets = sorted(set([asset for address, asset in series.iterkeys()]))
+    asset_rows = dict([(asset, i) for i, asset in enumerate(assets)])
+    balances = numpy.zeros((len(assets), len(grid))) #summed across all addresses
+    for (address, asset), e in series.iteritems():
+        balances[asset_rows[asset]] += _forward_fill(e['times'], e['balances'], grid, initial_value=e['initial'])
+
+    #PRICES: last trade price of each asset against SHP and SCH (and of SHP/SCH itself) at each interval point
+    trades = mongo_db.trades.find({
+            '$or': [
+                {'base_asset': {'$in': assets}, 'quote_asset': {'$in': [config.XCP, config.BTC]}},
+                {'base_asset': config.XCP, 'quote_asset': config.BTC},
+            ],
+            'block_time': {'$gte': datetime.datetime.utcfromtimestamp(start_ts - PORTFOLIO_HISTORY_PRICE_LOOKBACK), '$lte': end_dt}
+        },
+        {'_id': 0, 'base_asset': 1, 'quote_asset': 1, 'block_time': 1, 'unit_price': 1}
+    ).sort('block_time', pymongo.ASCENDING)
+    trade_series = {} #(base_asset, quote_asset) -> (times, unit_prices)
+    for t in trades:
+        e = trade_series.setdefault((t['base_asset'], t['quote_asset']), ([], []))
+        e[0].append(_to_ts(t['block_time']))
+        e[1].append(t['unit_price'])
+
+    def price_series(base_asset, quote_asset):
+        times, unit_prices = trade_series.get((base_asset, quote_asset), ([], []))
+        return _forward_fill(times, unit_prices, grid)
+
+    xcp_btc_prices = price_series(config.XCP, config.BTC) #SCH per SHP
+    prices_in_xcp = numpy.empty((len(assets), len(grid)))
+    prices_in_btc = numpy.empty((len(assets), len(grid)))
+    for asset, i in asset_rows.iteritems():
+        if asset == config.XCP:
+            prices_in_xcp[i] = 1.0
+            prices_in_btc[i] = xcp_btc_prices
+        elif asset == config.BTC:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                prices_in_xcp[i] = numpy.where(xcp_btc_prices > 0, 1.0 / xcp_btc_prices, numpy.nan)
+            prices_in_btc[i] = 1.0
+        else:
+            prices_in_xcp[i] = price_series(asset, config.XCP)
+            prices_in_btc[i] = price_series(asset, config.BTC)
+
+    #VALUES: per interval point, the dot product of the balance and price columns (unpriced holdings count as 0)
+    values_in_xcp = numpy.einsum('ij,ij->j', balances, numpy.nan_to_num(prices_in_xcp)) if len(assets) else numpy.zeros(len(grid))
+    values_in_btc = numpy.einsum('ij,ij->j', balances, numpy.nan_to_num(prices_in_btc)) if len(assets) else numpy.zeros(len(grid))
+    grid_ms = (grid * 1000).astype(numpy.int64).tolist()
+    return {
+        'interval': interval,
+        'assets': assets,
+        'value_in_{}'.format(config.XCP.lower()): zip(grid_ms, values_in_xcp.tolist()),
+        'value_in_{}'.format(config.BTC.lower()): zip(grid_ms, values_in_btc.tolist()),
+    }
@@ -0,0 +1,76 @@
+"""
+Keeps a per-block snapshot of the current market prices of all assets (in SHP and SCH) as NumPy vectors, so that
+price data for many assets at once can be served without any per-asset Mongo queries
+"""
+import logging
+
+import numpy
+
+from lib import config
+
+MAX_ASSETS_PER_REQUEST = 1000
+#asset_market_info fields loaded into the snapshot, per quote asset
+PRICE_FIELDS = ('price_in_{}', 'aggregated_price_in_{}', '24h_vol_price_change_in_{}')
+
+_snapshot = {'block_index': None, 'asset_indexes': {}, 'vectors': {}}
+
+def invalidate():
+    _snapshot['block_index'] = None
+
+def _get_snapshot():
+    if _snapshot['block_index'] == config.CURRENT_BLOCK_INDEX and _snapshot['block_index'] is not None:
+        return _snapshot
+
+    mongo_db = config.mongo_db
+    block_index = config.CURRENT_BLOCK_INDEX #store now as it may change while we are loading
+    fields = [f.format(quote_asset.lower()) for quote_asset in (config.XCP, config.BTC) for f in PRICE_FIELDS]
+    projection = dict([(f, 1) for f in fields])
+    projection.update({'_id': 0, 'asset': 1})
+    market_info = list(mongo_db.asset_market_info.find({}, projection))
+
+    #one float vector per field, with NaN marking a missing price
+    vectors = dict([(f, numpy.array([e.get(f) for e in market_info], dtype=numpy.float64)) for f in fields])
+    _snapshot['asset_indexes'] = dict([(e['asset'], i) for i, e in enumerate(market_info)])
+    _snapshot['vectors'] = vectors
+    _snapshot['block_index'] = block_index
+    logging.debug("Loaded price snapshot for %i assets at block %s" % (len(market_info), block_index))
+    return _snapshot
+
+def get_price_vectors(assets, fields):
+    """Returns a dict of field -> NumPy float vector of that field's value for each of the specified assets (in order),
+    with NaN wherever an asset has no such price"""
+    snapshot = _get_snapshot()
+    indexes = numpy.array([snapshot['asset_indexes'].get(asset, -1) for asset in assets], dtype=numpy.int64)
+    found = indexes >= 0
+    indexes[~found] = 0 #any valid index, masked out below
+
+    vectors = {}
+    for field in fields:
+        if snapshot['asset_indexes']:
+            values = snapshot['vectors'][field].take(indexes)
+            values[~found] = numpy.nan
+        else:
+            values = numpy.empty(len(assets)); values.fill(numpy.nan)
+        vectors[field] = values
+    return vectors
+
+def get_prices(assets, quotes=None):
+    """Returns the current market price, aggregated market price and 24h price change for each of the specified
+    assets, expressed in each of the specified quote assets (SHP and/or SCH). Values are None where not available.
+    """
+    if not quotes: quotes = [config.XCP, config.BTC]
+    if not isinstance(assets, list) or not isinstance(quotes, list):
+        raise Exception("assets and quotes must be lists")
+    if len(assets) > MAX_ASSETS_PER_REQUEST:
+        raise Exception("Too many assets requested (max %i)" % MAX_ASSETS_PER_REQUEST)
+    for quote_asset in quotes:
+        if quote_asset not in (config.XCP, config.BTC):
+            raise Exception("Invalid quote asset: %s" % quote_asset)
+
+    fields = [f.format(quote_asset.lower()) for quote_asset in quotes for f in PRICE_FIELDS]
+    vectors = get_price_vectors(assets, fields)
+    results = dict([(asset, {}) for asset in assets])
+    for field in fields:
+        for asset, value, is_missing in zip(assets, vectors[field].tolist(), numpy.isnan(vectors[field]).tolist()):
+            results[asset][field] = None if is_missing else value
+    return results
@@ -0,0 +1,120 @@
+"""
+Keeps an in-memory graph of all asset pairs with recent trades, and uses it to derive cross rates (prices expressed
+in SHP or SCH) for assets that do not have a direct market against either.
+
+Each edge carries the pair's market price (WVAP over the last MARKET_PRICE_DERIVE_NUM_POINTS trades, as with
+get_market_price_summary) and its liquidity (number of trades in the pricing window). Edges are reloaded only for
+pairs that saw new trades (or that had trades fall out of the pricing window since they were loaded), and cross rates
+for all assets are recomputed at most once per block, with one shortest-path pass per quote asset (where more liquid
+pairs are cheaper to traverse).
+"""
+import logging
+import datetime
+import heapq
+
+import pymongo
+
+from lib import config, util
+
+PRICING_WINDOW = datetime.timedelta(days=10) #same default window as get_market_price_summary
+
+_edges = {} #(base_asset, quote_asset) -> {'price': ..., 'trade_count': ..., 'last_trade_time': ..., 'first_trade_time': ...}
+_dirty_pairs = set()
+_state = {'needs_rebuild': True, 'refreshed_block_index': None, 'cross_rates': {}}
+
+def reset():
+    """Forces a full rebuild of the graph on next use (e.g. after a reorg or reparse)"""
+    _edges.clear()
+    _dirty_pairs.clear()
+    _state['needs_rebuild'] = True
+    _state['refreshed_block_index'] = None
+    _state['cross_rates'] = {}
+
+def mark_pair_dirty(asset1, asset2):
+    """Flags the pair's edge to be reloaded on the next refresh (call when a trade for the pair is booked)"""
+    _dirty_pairs.add(util.assets_to_asset_pair(asset1, asset2))
+
+def _load_edges(pairs=None):
+    """Loads edge data for the specified pairs (or all recently traded pairs, if not specified) in a single query"""
+    mongo_db = config.mongo_db
+    start_dt = datetime.datetime.utcnow() - PRICING_WINDOW
+    query = {'block_time': {"$gte": start_dt}}
+    if pairs is not None:
+        if not pairs: return {}
+        query['$or'] = [{'base_asset': base_asset, 'quote_asset': quote_asset} for base_asset, quote_asset in pairs]
+    trades = mongo_db.trades.find(query,
+        {'_id': 0, 'base_asset': 1, 'quote_asset': 1, 'block_time': 1, 'unit_price': 1,
+         'base_quantity_normalized': 1, 'quote_quantity_normalized': 1}
+    ).sort("block_time", pymongo.DESCENDING)
+
+    edges = {}
+    for t in trades: #newest to oldest
+        pair = (t['base_asset'], t['quote_asset'])
+        e = edges.setdefault(pair, {'trade_count': 0, 'last_trade_time': t['block_time'], 'price_data': [], 'vol_data': []})
+        e['trade_count'] += 1
+        e['first_trade_time'] = t['block_time'] #(the oldest trade in the window, so far)
+        if len(e['price_data']) < config.MARKET_PRICE_DERIVE_NUM_POINTS:
+            e['price_data'].append(t['unit_price'])
+            e['vol_data'].append(t['base_quantity_normalized'] + t['quote_quantity_normalized'])
+    for pair, e in edges.iteritems():
+        vol = sum(e['vol_data'])
+        e['price'] = sum(p * v for p, v in zip(e.pop('price_data'), e['vol_data'])) / vol if vol else None
+        del e['vol_data']
+    return edges
+
+def _shortest_paths(adjacency, quote_asset):
+    """Dijkstra from the quote asset outwards. Returns a dict of asset -> price of 1 unit of that asset in quote_asset"""
+    rates = {quote_asset: 1.0}
+    costs = {quote_asset: 0.0}
+    heap = [(0.0, quote_asset)]
+    while heap:
+        cost, asset = heapq.heappop(heap)
+        if cost > costs[asset]: continue #stale heap entry
+        for neighbor, rate_to_neighbor, edge_cost in adjacency.get(asset, []):
+            new_cost = cost + edge_cost
+            if neighbor not in costs or new_cost < costs[neighbor]:
+                costs[neighbor] = new_cost
+                #1 unit of neighbor is worth (1 / rate_to_neighbor) units of asset, which in turn is worth rates[asset] each
+                rates[neighbor] = rates[asset] / rate_to_neighbor
+                heapq.heappush(heap, (new_cost, neighbor))
+    return rates
+
+def _refresh():
+    if _state['refreshed_block_index'] == config.CURRENT_BLOCK_INDEX and not _state['needs_rebuild']:
+        return
+
+    if _state['needs_rebuild']:
+        _edges.clear()
+        _edges.update(_load_edges())
+        _state['needs_rebuild'] = False
+    else:
+        #reload pairs with new trades, as well as those whose oldest trade has since fallen out of the pricing window
+        # (their trade count, and possibly their price, have changed; if no trades are left, they are dropped)
+        start_dt = datetime.datetime.utcnow() - PRICING_WINDOW
+        stale_pairs = list(_dirty_pairs | set([pair for pair, e in _edges.iteritems() if e['first_trade_time'] < start_dt]))
+        for pair in stale_pairs: _edges.pop(pair, None)
+        _edges.update(_load_edges(stale_pairs))
+    _dirty_pairs.clear()
+
+    adjacency = {}
+    for (base_asset, quote_asset), e in _edges.iteritems():
+        if not e['price']: continue
+        edge_cost = 1.0 / e['trade_count']
+        adjacency.setdefault(base_asset, []).append((quote_asset, e['price'], edge_cost))
+        adjacency.setdefault(quote_asset, []).append((base_asset, 1.0 / e['price'], edge_cost))
+    _state['cross_rates'] = dict([(quote_asset, _shortest_paths(adjacency, quote_asset)) for quote_asset in (config.XCP, config.BTC)])
+    _state['refreshed_block_index'] = config.CURRENT_BLOCK_INDEX
+    logging.debug("Pricing graph refreshed at block %s: %i pairs, %i assets priced in %s, %i in %s" % (
+        config.CURRENT_BLOCK_INDEX, len(_edges), len(_state['cross_rates'][config.XCP]), config.XCP,
+        len(_state['cross_rates'][config.BTC]), config.BTC))
+
+def get_cross_rates(quote_asset):
+    """Returns a dict of asset -> current price of 1 unit of that asset expressed in quote_asset (SHP or SCH), for all
+    assets reachable from quote_asset through recently traded pairs"""
+    assert quote_asset in (config.XCP, config.BTC)
+    _refresh()
+    return _state['cross_rates'][quote_asset]
+
+def get_cross_rate(asset, quote_asset):
+    """Returns the current price of asset expressed in quote_asset (SHP or SCH), or None if it can't be derived"""
+    return get_cross_rates(quote_asset).get(asset, None)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 VERSION = "1.4.0" #should keep up with the counterwallet version it works with (for now at least)
 
-DB_VERSION = 22 #a db version increment will cause counterblockd to rebuild its database off of counterpartyd 
+DB_VERSION = 23 #a db version increment will cause counterblockd to rebuild its database off of counterpartyd 
 
 CAUGHT_UP = False #atomic state variable, set to True when counterpartyd AND counterblockd are caught up
 
@@ -10,7 +10,11 @@ UNIT = 100000000
 SUBDIR_ASSET_IMAGES = "asset_img" #goes under the data dir and stores retrieved asset images
 SUBDIR_FEED_IMAGES = "feed_img" #goes under the data dir and stores retrieved feed images
 
+TX_LOG_QUEUE_SIZE = 10000 #max number of transaction log entries waiting to be written out, before new ones get dropped
+
 MARKET_PRICE_DERIVE_NUM_POINTS = 8 #number of last trades over which to derive the market price (via WVAP)
+MARKET_PRICE_SUMMARY_CACHE_SIZE = 5000 #max number of (pair, time window, with_last_trades) market price summaries kept in memory
+USERS_PAIRS_CACHE_SIZE = 1000 #max number of (addresses, max_pairs, block) get_users_pairs results kept in memory
 
 # FROM counterpartyd
 # NOTE: These constants must match those in counterpartyd/lib/config.py
@@ -14,11 +14,15 @@ import gevent
 from PIL import Image
 
 from lib import config, util, blockchain
-from lib.components import assets, assets_trading, betting
+from lib.components import assets, assets_trading, betting, dex
 
 D = decimal.Decimal
 COMPILE_MARKET_PAIR_INFO_PERIOD = 10 * 60 #in seconds (this is every 10 minutes currently)
 COMPILE_ASSET_MARKET_INFO_PERIOD = 30 * 60 #in seconds (this is every 30 minutes currently)
+COMPILE_MARKETS_LIST_CHECK_PERIOD = 5 #in seconds (how often to check for a new block to compile the markets list for)
+BLOCKCHAIN_TIP_POLL_MIN_PERIOD = 5 #in seconds (how often to poll for a new chain tip, once one is due)
+BLOCKCHAIN_TIP_POLL_MAX_PERIOD = 30 #in seconds (how often to poll right after a new tip, or when the service is erroring)
+BLOCKCHAIN_TIP_POLL_RAMP_PERIOD = 5 * 60 #in seconds (time after a new tip over which polling speeds up from the max to the min period)
 
 def check_blockchain_service():
     try:
@@ -28,6 +32,21 @@ def check_blockchain_service():
     finally:
         gevent.spawn_later(5 * 60, check_blockchain_service) #call again in 5 minutes
 
+def track_blockchain_tip():
+    """Keeps the blockchain service's chain tip current in memory (see blockchain.get_tip), polling more often the
+    longer it has been since the last new block"""
+    period = BLOCKCHAIN_TIP_POLL_MAX_PERIOD
+    try:
+        blockchain.update_tip()
+        tip = blockchain.get_tip()
+        since_changed = time.time() - tip['changed_at'] if tip['changed_at'] else 0
+        period = max(BLOCKCHAIN_TIP_POLL_MIN_PERIOD, BLOCKCHAIN_TIP_POLL_MAX_PERIOD
+            - (BLOCKCHAIN_TIP_POLL_MAX_PERIOD - BLOCKCHAIN_TIP_POLL_MIN_PERIOD) * since_changed / BLOCKCHAIN_TIP_POLL_RAMP_PERIOD)
+    except Exception, e:
+        logging.warn("Could not update the blockchain tip: %s" % e)
+    finally:
+        gevent.spawn_later(period, track_blockchain_tip)
+
 def expire_stale_prefs():
     """
     Every day, clear out preferences objects that haven't been touched in > 30 days, in order to reduce abuse risk/space consumed
@@ -188,4 +207,15 @@ def compile_asset_market_info():
     assets_trading.compile_asset_market_info()
     #all done for this run...call again in a bit                            
     gevent.spawn_later(COMPILE_ASSET_MARKET_INFO_PERIOD, compile_asset_market_info)
-    
+
+def compile_markets_list(zmq_publisher_eventfeed):
+    """Recompiles the dex markets list once per new block (including while catching up), and pushes it out to
+    socket.io clients (if enabled, and once caught up)"""
+    try:
+        if dex.get_markets_list_snapshot_block_index() != config.CURRENT_BLOCK_INDEX:
+            snapshot = dex.compile_markets_list(config.mongo_db)
+            logging.debug("Compiled markets list for block %s (%i markets)" % (snapshot['block_index'], len(snapshot['markets'])))
+            if config.PUSH_MARKETS_LIST and config.CAUGHT_UP:
+                zmq_publisher_eventfeed.send_multipart(['markets_list', snapshot['json']])
+    finally:
+        gevent.spawn_later(COMPILE_MARKETS_LIST_CHECK_PERIOD, compile_markets_list, zmq_publisher_eventfeed)
@@ -6,6 +6,7 @@ import socket
 import collections
 import json
 
+import gevent
 import zmq.green as zmq
 import pymongo
 from socketio import socketio_manage
@@ -17,40 +18,45 @@ from lib import config, util
 onlineClients = {} #key = walletID, value = datetime when connected
 #^ tracks "online status" via the chat feed
 
-class MessagesFeedServerNamespace(BaseNamespace):
-    def __init__(self, *args, **kwargs):
-        super(MessagesFeedServerNamespace, self).__init__(*args, **kwargs)
-        self._running = True
-            
-    def listener(self):
-        #subscribe to the zmq queue
-        sock = self.request['zmq_context'].socket(zmq.SUB)
+class MessagesFeedHub(object):
+    """
+    Single subscriber to the event feed queue that fans each event out to all connected socket.io clients.
+    The blockfeed serializes each event once; that JSON payload is spliced as-is into the socket.io event frame, so
+    events are neither decoded nor re-encoded per client.
+    """
+    def __init__(self, zmq_context):
+        self.zmq_context = zmq_context
+        self.listeners = set() #of MessagesFeedServerNamespace
+        gevent.spawn(self.run)
+
+    def run(self):
+        sock = self.zmq_context.socket(zmq.SUB)
         sock.setsockopt(zmq.SUBSCRIBE, "")
         sock.connect('inproc://queue_eventfeed')
-        
-        poller = zmq.Poller()
-        poller.register(sock, zmq.POLLIN)
-        
-        #as we receive messages, send them out to the socket.io listener
-        #do this in a way that doesn't block indefinitely, and gracefully falls through if/when a client disconnects
-        while self._running:
-            socks = poller.poll(2500) #wait *up to* 2.5 seconds for events to arrive
-            if socks:
-                event = socks[0][0].recv_json() #only one sock we're polling
-                #logging.info("socket.io: Sending message ID %s -- %s:%s" % (
-                #    event['_message_index'], event['_category'], event['_command']))
-                self.emit(event['_category'], event)
-        #sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+        while True:
+            category, payload = sock.recv_multipart()
+            if not self.listeners:
+                continue
+            frames = {} #socket.io event frame (see socketio.packet.encode), per endpoint
+            for listener in list(self.listeners):
+                endpoint = listener.ns_name
+                if endpoint not in frames:
+                    frames[endpoint] = '5::%s:{"name":%s,"args":[%s]}' % (endpoint, json.dumps(category), payload)
+                try:
+                    listener.socket.put_client_msg(frames[endpoint])
+                except Exception, e:
+                    logging.warn("socket.io: Could not send event to client, dropping listener: %s" % e)
+                    self.listeners.discard(listener)
 
+class MessagesFeedServerNamespace(BaseNamespace):
     def on_subscribe(self):
         if 'listening' not in self.socket.session:
             self.socket.session['listening'] = True
-            self.spawn(self.listener)
+            self.request['hub'].listeners.add(self)
             
     def disconnect(self, silent=False):
         """Triggered when the client disconnects (e.g. client closes their browser)"""
-        self._running = False
+        self.request['hub'].listeners.discard(self)
         return super(MessagesFeedServerNamespace, self).disconnect(silent=silent)
 
         
@@ -62,6 +68,7 @@ class SocketIOMessagesFeedServer(object):
         # Dummy request object to maintain state between Namespace initialization.
         self.request = {
             'zmq_context': zmq_context,
+            'hub': MessagesFeedHub(zmq_context),
         }        
             
     def __call__(self, environ, start_response):
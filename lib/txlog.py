@@ -0,0 +1,159 @@
+"""
+Transaction log: records API requests and their responses, off of the request greenlet.
+
+Entries are put on a bounded queue and written out in batches by a background greenlet, with the actual disk I/O done
+in the gevent hub's threadpool. When the queue is full, entries are dropped (and counted) rather than blocking the caller.
+"""
+import os
+import time
+import glob
+import gzip
+import random
+import logging
+
+import gevent
+import gevent.queue
+
+from lib import config
+
+WRITE_BATCH_SIZE = 500 #max number of entries written out to disk at a time
+STATS_LOG_PERIOD = 300 #log the transaction log stats (if anything was dropped) at most every this many seconds
+
+_queue = None
+_writer = None
+_segment_writer = None
+_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'sampled_out': 0, 'truncated': 0, 'write_errors': 0}
+
+def parse_sample_rates(sample_rates_str):
+    """Parses a "method:rate,method:rate" string (rates from 0 to 1, with a method of * setting the default rate) into a dict"""
+    sample_rates = {}
+    for pair in [p.strip() for p in sample_rates_str.split(',') if p.strip()]:
+        method, rate = pair.split(':')
+        rate = float(rate)
+        if rate < 0 or rate > 1:
+            raise Exception("Invalid transaction log sample rate for method '%s': %s" % (method, rate))
+        sample_rates[method.strip()] = rate
+    return sample_rates
+
+def _format_entry(message):
+    return "%s %s\n" % (time.strftime('%Y-%m-%d-T%H:%M:%S%z'), message)
+
+class _SegmentWriter(object):
+    """Writes to the transaction log file, rotating it once it reaches max_bytes in size. If compress is set, the log is
+    instead written as a series of gzip-compressed segment files (<log file>.<timestamp>.gz)"""
+    def __init__(self, path, max_bytes, backup_count, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.f = None
+        self.num_bytes = 0
+
+    def _open(self):
+        if self.compress:
+            self.f = gzip.open("%s.%s.gz" % (self.path, time.strftime('%Y%m%d%H%M%S')), 'ab')
+            self.num_bytes = 0 #(uncompressed bytes written to this segment)
+        else:
+            self.f = open(self.path, 'a')
+            self.num_bytes = self.f.tell()
+
+    def _rotate(self):
+        self.f.close()
+        self.f = None
+        if self.compress:
+            segments = sorted(glob.glob("%s.*.gz" % self.path))
+            for segment in segments[:max(len(segments) - self.backup_count, 0)]:
+                os.remove(segment)
+        else: #same scheme as logging.handlers.RotatingFileHandler.doRollover
+            #(targets are removed before renaming onto them, as os.rename won't replace an existing file on Windows)
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists("%s.%i" % (self.path, i)):
+                    if os.path.exists("%s.%i" % (self.path, i + 1)):
+                        os.remove("%s.%i" % (self.path, i + 1))
+                    os.rename("%s.%i" % (self.path, i), "%s.%i" % (self.path, i + 1))
+            if os.path.exists("%s.1" % self.path):
+                os.remove("%s.1" % self.path)
+            os.rename(self.path, "%s.1" % self.path)
+
+    def write(self, entries):
+        if self.f is None:
+            self._open()
+        data = ''.join(e.encode('utf-8') if isinstance(e, unicode) else e for e in entries)
+        self.f.write(data)
+        self.f.flush()
+        self.num_bytes += len(data)
+
+    def rotate_if_needed(self):
+        if self.f is not None and self.backup_count > 0 and self.num_bytes >= self.max_bytes:
+            #(like RotatingFileHandler, never rotates without backups)
+            self._rotate()
+
+def _write_entries(segment_writer):
+    last_stats_logged_at = time.time()
+    while True:
+        entries = [_queue.get(),]
+        while len(entries) < WRITE_BATCH_SIZE and not _queue.empty():
+            entries.append(_queue.get_nowait())
+        try:
+            #write from a real thread, so that slow disk I/O doesn't block the gevent loop
+            gevent.get_hub().threadpool.apply(segment_writer.write, (entries,))
+            _stats['written'] += len(entries)
+        except Exception, e:
+            _stats['write_errors'] += 1
+            logging.warn("Could not write %i entries to the transaction log: %s" % (len(entries), e))
+        try:
+            gevent.get_hub().threadpool.apply(segment_writer.rotate_if_needed)
+        except Exception, e:
+            logging.warn("Could not rotate the transaction log: %s" % e)
+        if _stats['dropped'] and time.time() - last_stats_logged_at >= STATS_LOG_PERIOD:
+            logging.warn("Transaction log stats: %s" % get_stats())
+            last_stats_logged_at = time.time()
+
+def init(max_bytes, backup_count):
+    """Starts up the transaction log writer greenlet"""
+    global _queue, _writer, _segment_writer
+    _queue = gevent.queue.Queue(maxsize=config.TX_LOG_QUEUE_SIZE)
+    _segment_writer = _SegmentWriter(config.TX_LOG, max_bytes, backup_count, compress=config.TX_LOG_COMPRESS)
+    _writer = gevent.spawn(_write_entries, _segment_writer)
+
+def flush():
+    """Writes out any queued entries synchronously (e.g. on shutdown)"""
+    if _queue is None or _segment_writer is None:
+        return
+    entries = []
+    while not _queue.empty():
+        entries.append(_queue.get_nowait())
+    if entries:
+        _segment_writer.write(entries)
+        _stats['written'] += len(entries)
+
+def log_entry(message):
+    """Queues up a message to be written to the transaction log. Never blocks: if the queue is full, the message is dropped"""
+    if _queue is None: #not initialized
+        return False
+    try:
+        _queue.put_nowait(_format_entry(message))
+    except gevent.queue.Full:
+        _stats['dropped'] += 1
+        return False
+    _stats['queued'] += 1
+    return True
+
+def log_transaction(method, request_json, response_json):
+    """Queues up the request and response of an API call to be written to the transaction log, subject to the method's
+    sample rate, and with the response truncated to config.TX_LOG_MAX_RESPONSE_LENGTH characters (if set)"""
+    sample_rate = config.TX_LOG_SAMPLE_RATES.get(method, config.TX_LOG_SAMPLE_RATES.get('*', 1.0))
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        _stats['sampled_out'] += 1
+        return False
+    if config.TX_LOG_MAX_RESPONSE_LENGTH and len(response_json) > config.TX_LOG_MAX_RESPONSE_LENGTH:
+        response_json = "%s... (truncated, %i characters total)" % (
+            response_json[:config.TX_LOG_MAX_RESPONSE_LENGTH], len(response_json))
+        _stats['truncated'] += 1
+    return log_entry("TRANSACTION --- %s ||| REQUEST: %s ||| RESPONSE: %s" % (method, request_json, response_json))
+
+def get_stats():
+    """Returns the transaction log's counters, along with the current queue backlog"""
+    stats = dict(_stats)
+    stats['backlog'] = _queue.qsize() if _queue is not None else 0
+    return stats
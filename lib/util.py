@@ -5,12 +5,13 @@ import base64
 import logging
 import datetime
 import time
-import copy
 import decimal
 import cgi
 import itertools
+import collections
 import StringIO
 import subprocess
+import zlib
 
 import gevent
 import gevent.pool
@@ -124,24 +125,59 @@ def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_err
         raise Exception("Got back error from server: %s" % result['error'])
     return result
 
-def get_url(url, abort_on_error=False, is_json=True, fetch_timeout=5):
-    headers = { 'Connection':'close', } #no keepalive
+HTTP_CLIENT_STATS_WINDOW = 100 #number of latest requests to each host that its latency stats are derived from
+_http_clients = {} #(scheme, host, port, timeout) -> pooled, keep-alive HTTPClient
+_http_host_stats = {} #host -> {'requests': ..., 'errors': ..., 'latencies': ...}
 
-    try:
-        u = URL(url)
-        client_kwargs = {'connection_timeout': fetch_timeout, 'network_timeout': fetch_timeout, 'insecure': True}
+def _get_http_client(u, fetch_timeout):
+    key = (u.scheme, u.host, u.port, fetch_timeout)
+    if key not in _http_clients:
+        client_kwargs = {'connection_timeout': fetch_timeout, 'network_timeout': fetch_timeout, 'insecure': True,
+            'concurrency': config.HTTP_CLIENT_CONCURRENCY}
         if u.scheme == "https": client_kwargs['ssl_options'] = {'cert_reqs': gevent.ssl.CERT_NONE}
-        client = HTTPClient.from_url(u, **client_kwargs)
-        r = client.get(u.request_uri, headers=headers)
+        _http_clients[key] = HTTPClient.from_url(u, **client_kwargs)
+    return _http_clients[key]
+
+def _get_http_host_stats(host):
+    if host not in _http_host_stats:
+        _http_host_stats[host] = {'requests': 0, 'errors': 0,
+            'latencies': collections.deque(maxlen=HTTP_CLIENT_STATS_WINDOW)}
+    return _http_host_stats[host]
+
+def get_http_client_stats():
+    """Returns request count, error count and p50/p95 latency (over the latest requests) per host fetched from by get_url"""
+    stats = {}
+    for host, host_stats in _http_host_stats.iteritems():
+        latencies = sorted(host_stats['latencies'])
+        stats[host] = {
+            'requests': host_stats['requests'],
+            'errors': host_stats['errors'],
+            'latency_p50': latencies[int(round(0.5 * (len(latencies) - 1)))] if latencies else None,
+            'latency_p95': latencies[int(round(0.95 * (len(latencies) - 1)))] if latencies else None,
+        }
+    return stats
+
+def get_url(url, abort_on_error=False, is_json=True, fetch_timeout=5):
+    """Fetches the URL with a shared, keep-alive connection pool for its host (so repeated requests to the same host
+    don't each pay for a new connection and TLS handshake)"""
+    u = URL(url)
+    stats = _get_http_host_stats(u.host)
+    stats['requests'] += 1
+    start = time.time()
+    try:
+        client = _get_http_client(u, fetch_timeout)
+        r = client.get(u.request_uri, headers={'Accept-Encoding': 'gzip'})
+        body = r.read() #(reading the whole body returns the connection to the pool)
     except Exception, e:
+        stats['errors'] += 1
         raise Exception("Got get_url request error: %s" % e)
-    else:
-        if r.status_code != 200 and abort_on_error:
-            raise Exception("Bad status code returned: '%s'. result body: '%s'." % (r.status_code, r.read()))
-        result = json.loads(r.read()) if is_json else r.read()
-    finally:
-        client.close()
-    return result
+    stats['latencies'].append(time.time() - start)
+
+    if r.get('content-encoding', '').lower() == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if r.status_code != 200 and abort_on_error:
+        raise Exception("Bad status code returned: '%s'. result body: '%s'." % (r.status_code, body))
+    return json.loads(body) if is_json else body
 
 def get_address_cols_for_entity(entity):
     if entity in ['debits', 'credits']:
@@ -179,6 +215,87 @@ def multikeysort(items, columns):
             return 0
     return sorted(items, cmp=comparer)
 
+class LRUCache(object):
+    """A bounded, in-process least-recently-used cache that keeps hit/miss statistics. If a group_of callable is given,
+    keys are also indexed by group_of(key), so that all of a group's entries can be dropped with invalidate_group"""
+    _MISSING = object()
+
+    def __init__(self, max_size=1000, group_of=None):
+        assert max_size > 0
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._group_of = group_of
+        self._groups = {} #group -> set of keys (if group_of is given)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        value = self._data.pop(key, self._MISSING)
+        if value is self._MISSING:
+            self.misses += 1
+            return default
+        self._data[key] = value #re-insert as the most recently used entry
+        self.hits += 1
+        return value
+
+    def _forget_key(self, key):
+        if self._group_of is not None:
+            group = self._group_of(key)
+            self._groups[group].discard(key)
+            if not self._groups[group]:
+                del self._groups[group]
+
+    def set(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        else:
+            if len(self._data) >= self.max_size:
+                evicted_key, evicted_value = self._data.popitem(last=False) #evict the least recently used entry
+                self._forget_key(evicted_key)
+                self.evictions += 1
+            if self._group_of is not None:
+                self._groups.setdefault(self._group_of(key), set()).add(key)
+        self._data[key] = value
+
+    def invalidate(self, match=None):
+        """Removes all entries, or only those whose key the match callable returns True for.
+        Returns the number of entries removed"""
+        keys = self._data.keys() if match is None else [k for k in self._data.iterkeys() if match(k)]
+        for key in keys:
+            del self._data[key]
+            self._forget_key(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def invalidate_group(self, group):
+        """Removes the entries in the specified group (without looking at any others). Returns the number removed"""
+        assert self._group_of is not None
+        keys = self._groups.pop(group, set())
+        for key in keys:
+            del self._data[key]
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
 def moving_average(samples, n=3) :
     ret = numpy.cumsum(samples, dtype=float)
     ret[n:] = ret[n:] - ret[:-n]
@@ -203,6 +320,9 @@ def json_dthandler(obj):
     else:
         raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
 
+#encoder for API responses: compact, with datetimes as epoch ms. reused, as setting up an encoder per call adds up
+JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), default=json_dthandler)
+
 def get_block_indexes_for_dates(start_dt=None, end_dt=None):
     """Returns a 2 tuple (start_block, end_block) result for the block range that encompasses the given start_date
     and end_date unix timestamps"""
@@ -229,37 +349,72 @@ def get_block_time(block_index):
     if not block: return None
     return block['block_time']
 
-def decorate_message(message, for_txn_history=False):
+def get_block_times(block_indexes):
+    """Returns a dict of block_index -> block_time for the specified blocks, in one query"""
+    blocks = config.mongo_db.processed_blocks.find({"block_index": {"$in": list(set(block_indexes))} },
+        {'_id': 0, 'block_index': 1, 'block_time': 1})
+    return dict([(b['block_index'], b['block_time']) for b in blocks])
+
+#running totals for decorate_messages, showing how many per-message queries batching saves
+DECORATE_MESSAGES_STATS = {'calls': 0, 'messages': 0, 'queries': 0, 'queries_saved': 0}
+DECORATE_ASSET_FIELDS = {
+    #category: (fields holding the assets whose info is needed, whether only needed for inserts)
+    'orders': (['get_asset', 'give_asset'], True),
+    'order_matches': (['forward_asset', 'backward_asset'], True),
+    'dividends': (['asset'], False),
+    'sends': (['asset'], False),
+    'callbacks': (['asset'], False),
+}
+
+def _get_assets_to_lookup(message):
+    if message['_category'] not in DECORATE_ASSET_FIELDS:
+        return []
+    fields, inserts_only = DECORATE_ASSET_FIELDS[message['_category']]
+    if inserts_only and message['_command'] != 'insert':
+        return []
+    return [message[f] for f in fields]
+
+def decorate_message(message, for_txn_history=False, block_times=None, bal_changes=None, asset_infos=None):
     #insert custom fields in certain events...
     #even invalid actions need these extra fields for proper reporting to the client (as the reporting message
     # is produced via PendingActionViewModel.calcText) -- however make it able to deal with the queried data not existing in this case
+    #block_times, bal_changes and asset_infos may hold data already looked up in bulk (see decorate_messages)
     assert '_category' in message
     mongo_db = config.mongo_db
+
+    def lookup_asset_info(asset):
+        if asset_infos is not None:
+            return asset_infos.get(asset, None)
+        return mongo_db.tracked_assets.find_one({'asset': asset})
+
     if for_txn_history:
         message['_command'] = 'insert' #history data doesn't include this
         block_index = message['block_index'] if 'block_index' in message else message['tx1_block_index']
-        message['_block_time'] = get_block_time(block_index)
+        message['_block_time'] = block_times.get(block_index, None) if block_times is not None else get_block_time(block_index)
         message['_tx_index'] = message['tx_index'] if 'tx_index' in message else message.get('tx1_index', None)
         if message['_category'] in ['bet_expirations', 'order_expirations', 'bet_match_expirations', 'order_match_expirations']:
             message['_tx_index'] = 0 #add tx_index to all entries (so we can sort on it secondarily in history view), since these lack it
 
     if message['_category'] in ['credits', 'debits']:
         #find the last balance change on record
-        bal_change = mongo_db.balance_changes.find_one({ 'address': message['address'], 'asset': message['asset'] },
-            sort=[("block_time", pymongo.DESCENDING)])
+        if bal_changes is not None:
+            bal_change = bal_changes.get((message['address'], message['asset']), None)
+        else:
+            bal_change = mongo_db.balance_changes.find_one({ 'address': message['address'], 'asset': message['asset'] },
+                sort=[("block_time", pymongo.DESCENDING)])
         message['_quantity_normalized'] = abs(bal_change['quantity_normalized']) if bal_change else None
         message['_balance'] = bal_change['new_balance'] if bal_change else None
         message['_balance_normalized'] = bal_change['new_balance_normalized'] if bal_change else None
 
     if message['_category'] in ['orders',] and message['_command'] == 'insert':
-        get_asset_info = mongo_db.tracked_assets.find_one({'asset': message['get_asset']})
-        give_asset_info = mongo_db.tracked_assets.find_one({'asset': message['give_asset']})
+        get_asset_info = lookup_asset_info(message['get_asset'])
+        give_asset_info = lookup_asset_info(message['give_asset'])
         message['_get_asset_divisible'] = get_asset_info['divisible'] if get_asset_info else None
         message['_give_asset_divisible'] = give_asset_info['divisible'] if give_asset_info else None
 
     if message['_category'] in ['order_matches',] and message['_command'] == 'insert':
-        forward_asset_info = mongo_db.tracked_assets.find_one({'asset': message['forward_asset']})
-        backward_asset_info = mongo_db.tracked_assets.find_one({'asset': message['backward_asset']})
+        forward_asset_info = lookup_asset_info(message['forward_asset'])
+        backward_asset_info = lookup_asset_info(message['backward_asset'])
         message['_forward_asset_divisible'] = forward_asset_info['divisible'] if forward_asset_info else None
         message['_backward_asset_divisible'] = backward_asset_info['divisible'] if backward_asset_info else None
 
@@ -270,28 +425,94 @@ def decorate_message(message, for_txn_history=False):
         )
 
     if message['_category'] in ['dividends', 'sends', 'callbacks']:
-        asset_info = mongo_db.tracked_assets.find_one({'asset': message['asset']})
+        asset_info = lookup_asset_info(message['asset'])
         message['_divisible'] = asset_info['divisible'] if asset_info else None
 
     if message['_category'] in ['issuances',]:
         message['_quantity_normalized'] = util_bitcoin.normalize_quantity(message['quantity'], message['divisible'])
     return message
 
-def decorate_message_for_feed(msg, msg_data=None):
-    """This function takes a message from counterpartyd's message feed and mutates it a bit to be suitable to be
-    sent through the counterblockd message feed to an end-client"""
-    if not msg_data:
-        msg_data = json.loads(msg['bindings'])
+def decorate_messages(messages, for_txn_history=False):
+    """Batch version of decorate_message: looks up everything the messages need with at most one query per
+    collection (tracked_assets and processed_blocks), and one per distinct (address, asset) pair for balance_changes,
+    then decorates them in memory"""
+    mongo_db = config.mongo_db
+    if for_txn_history:
+        for message in messages:
+            message['_command'] = 'insert' #needed below, before decorate_message sets it
+    queries = 0
+    queries_unbatched = 0
 
-    message = copy.deepcopy(msg_data)
+    block_times = None
+    if for_txn_history:
+        block_times = get_block_times([m['block_index'] if 'block_index' in m else m['tx1_block_index'] for m in messages])
+        queries += 1
+        queries_unbatched += len(messages)
+
+    bal_changes = {}
+    bal_change_keys = set([(m['address'], m['asset']) for m in messages if m['_category'] in ['credits', 'debits']])
+    for address, asset in bal_change_keys:
+        #the last balance change on record for each distinct (address, asset) pair (an indexed lookup, where a single
+        # aggregate would have to sort the whole history of every address and asset involved)
+        bal_changes[(address, asset)] = mongo_db.balance_changes.find_one({'address': address, 'asset': asset},
+            {'_id': 0, 'quantity_normalized': 1, 'new_balance': 1, 'new_balance_normalized': 1},
+            sort=[("block_time", pymongo.DESCENDING)])
+    queries += len(bal_change_keys)
+    queries_unbatched += len([m for m in messages if m['_category'] in ['credits', 'debits']])
+
+    asset_infos = {}
+    assets = [asset for m in messages for asset in _get_assets_to_lookup(m)]
+    if assets:
+        for a in mongo_db.tracked_assets.find({'asset': {'$in': list(set(assets))}}, {'_id': 0, 'asset': 1, 'divisible': 1}):
+            asset_infos[a['asset']] = a
+        queries += 1
+        queries_unbatched += len(assets)
+
+    for message in messages:
+        decorate_message(message, for_txn_history=for_txn_history,
+            block_times=block_times, bal_changes=bal_changes, asset_infos=asset_infos)
+
+    DECORATE_MESSAGES_STATS['calls'] += 1
+    DECORATE_MESSAGES_STATS['messages'] += len(messages)
+    DECORATE_MESSAGES_STATS['queries'] += queries
+    DECORATE_MESSAGES_STATS['queries_saved'] += queries_unbatched - queries
+    logging.debug("decorate_messages: %i messages decorated with %i queries (%i saved). Totals: %s" % (
+        len(messages), queries, queries_unbatched - queries, DECORATE_MESSAGES_STATS))
+    return messages
+
+def _prepare_message_for_feed(msg, msg_data=None):
+    if not msg_data:
+        message = msg_data = json.loads(msg['bindings']) #freshly parsed, so ours to modify
+    else:
+        message = dict(msg_data) #decoration only adds top-level fields, so a shallow copy leaves msg_data untouched
     message['_message_index'] = msg['message_index']
     message['_command'] = msg['command']
     message['_block_index'] = msg['block_index']
     message['_category'] = msg['category']
     message['_status'] = msg_data.get('status', 'valid')
-    message = decorate_message(message)
     return message
 
+def decorate_message_for_feed(msg, msg_data=None):
+    """This function takes a message from counterpartyd's message feed and mutates it a bit to be suitable to be
+    sent through the counterblockd message feed to an end-client"""
+    return decorate_message(_prepare_message_for_feed(msg, msg_data))
+
+def decorate_messages_for_feed(msgs):
+    """Batch version of decorate_message_for_feed"""
+    return decorate_messages([_prepare_message_for_feed(msg) for msg in msgs])
+
+class PreSerializedJSON(str):
+    """JSON text for a result that was serialized ahead of time. The API handler splices it into the response as is,
+    instead of encoding it again"""
+    pass
+
+def publish_event(zmq_publisher, event):
+    """Serializes the event (exactly once) and publishes it to the event feed queue, along with its category.
+    The serialized payload is what every subscriber gets (see siofeeds.MessagesFeedHub)"""
+    payload = json.dumps(event, separators=(',', ':'), default=json_dthandler)
+    zmq_publisher.send_multipart([str(event['_category']), payload])
+    return payload
+
 def is_caught_up_well_enough_for_government_work():
     """We don't want to give users 525 errors or login errors if counterblockd/counterpartyd is in the process of
     getting caught up, but we DO if counterblockd is either clearly out of date with the blockchain, or reinitializing its database"""
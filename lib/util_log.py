@@ -0,0 +1,107 @@
+"""
+Non-blocking logging: log records are put on a bounded queue by a QueueHandler on the root logger (with their message
+formatted), and handed off to the real (console, file) handlers by a background greenlet, with the writing done in the
+gevent hub's threadpool.
+"""
+import time
+import logging
+
+import gevent
+import gevent.queue
+
+from lib import config
+
+INGEST_LOGGER_NAME = "ingest" #logger for per-message blockfeed logging (which is dropped while catching up, in ingest mode)
+QUEUE_SIZE = 50000 #max number of log records waiting to be written out, before new ones get dropped
+WRITE_BATCH_SIZE = 500 #max number of log records written out at a time
+STATS_LOG_PERIOD = 300 #log the logging stats (as a warning, if anything was dropped) every this many seconds
+
+_queue = gevent.queue.Queue(maxsize=QUEUE_SIZE)
+_target_handlers = []
+_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'ingest_dropped': 0}
+
+class QueueHandler(logging.Handler):
+    """Queues up log records for the writer greenlet, and if the queue is full, drops them rather than blocking the
+    caller. Records are only formatted once they make it past the logger's level (and filters), but then right away,
+    on the hub thread: their args may be mutable objects that change before the record would be written out"""
+    def createLock(self):
+        self.lock = None #queue puts don't need a lock
+
+    def prepare(self, record):
+        """Merges the message and args (and the traceback text, if any) into the record, as the stdlib (3.2+)
+        QueueHandler does"""
+        self.format(record) #(sets record.message, and record.exc_text if there is exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            _queue.put_nowait(record)
+        except gevent.queue.Full:
+            _stats['dropped'] += 1
+            return
+        _stats['queued'] += 1
+
+class IngestModeFilter(logging.Filter):
+    """Drops records below config.LOG_INGEST_LEVEL while counterblockd is catching up"""
+    def filter(self, record):
+        if config.CAUGHT_UP or record.levelno >= config.LOG_INGEST_LEVEL:
+            return True
+        _stats['ingest_dropped'] += 1
+        return False
+
+def _write_records(records):
+    for record in records:
+        for handler in _target_handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.emit(record)
+                except Exception:
+                    handler.handleError(record)
+
+def _write_queued():
+    last_stats_logged_at = time.time()
+    while True:
+        records = [_queue.get(),]
+        while len(records) < WRITE_BATCH_SIZE and not _queue.empty():
+            records.append(_queue.get_nowait())
+        #write from a real thread, so that disk I/O doesn't block the gevent loop
+        gevent.get_hub().threadpool.apply(_write_records, (records,))
+        _stats['written'] += len(records)
+        if time.time() - last_stats_logged_at >= STATS_LOG_PERIOD:
+            (logging.warn if _stats['dropped'] else logging.debug)("Logging stats: %s", get_stats())
+            last_stats_logged_at = time.time()
+
+def init(handlers):
+    """Moves the given handlers (already set up on the root logger) behind a QueueHandler, and starts up the writer greenlet"""
+    logger = logging.getLogger()
+    for handler in handlers:
+        logger.removeHandler(handler)
+        #the writer greenlet is the only user of these handlers from here on out, and it uses them from a real thread,
+        # where the (gevent monkey-patched) handler locks can't be used
+        handler.lock = None
+        _target_handlers.append(handler)
+    logger.addHandler(QueueHandler())
+    logging.getLogger(INGEST_LOGGER_NAME).addFilter(IngestModeFilter())
+    gevent.spawn(_write_queued)
+
+def flush():
+    """Writes out any queued log records synchronously (e.g. on shutdown)"""
+    records = []
+    while not _queue.empty():
+        records.append(_queue.get_nowait())
+    _write_records(records)
+    _stats['written'] += len(records)
+
+def get_stats():
+    """Returns the logging pipeline's counters, along with the current queue backlog"""
+    stats = dict(_stats)
+    stats['backlog'] = _queue.qsize()
+    return stats